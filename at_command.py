@@ -0,0 +1,68 @@
+'''
+Send AT commands to a serial modem and read the response up to its final result
+code, instead of waiting fixed delays for the modem to go quiet.
+'''
+
+import time
+import serial
+
+DEFAULT_TIMEOUT = 2.0
+
+# lines that end the response of a command
+FINAL_RESULTS = (b'OK', b'ERROR')
+FINAL_ERROR_PREFIXES = (b'+CMS ERROR', b'+CME ERROR')
+
+# sent by the modem when it waits for the text of an SMS
+SMS_PROMPT = b'>'
+
+def final_result(response):
+    """ The final result code line ending a response, None if there is none (yet)
+    """
+    lines = response.split(b'\r\n')
+    ## only a complete line that nothing followed yet can be the final result
+    if len(lines) < 2 or lines[-1] != b'':
+        return None
+    last = lines[-2].strip()
+    if last in FINAL_RESULTS or last.startswith(FINAL_ERROR_PREFIXES):
+        return last
+    return None
+
+def is_error(response):
+    result = final_result(response)
+    return result is not None and result != b'OK'
+
+class ATCommandEngine:
+    """ Runs one AT command at a time on an open serial.Serial. Callers serialize
+    commands themselves, eg. with a lock held across the commands of an SMS.
+    """
+
+    def __init__(self, port, default_timeout=DEFAULT_TIMEOUT):
+        self.port = port
+        self.default_timeout = default_timeout
+        self.commands = 0
+        self.timeouts = 0
+
+    def command(self, data, timeout=None, expect_prompt=False):
+        """ Write data and return the response once the final result code, or with
+        expect_prompt the '>' prompt, was read. Raises serial.SerialTimeoutException
+        if neither arrived within timeout seconds.
+        """
+        timeout = self.default_timeout if timeout is None else timeout
+        ## drop anything left over from an earlier command that timed out
+        self.port.reset_input_buffer()
+        self.port.write(data)
+        self.commands += 1
+
+        deadline = time.monotonic() + timeout
+        response = b''
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                raise serial.SerialTimeoutException("No final result for " + repr(data) + " after " + str(timeout) + " s: " + repr(response))
+            self.port.timeout = remaining
+            response += self.port.read(max(1, self.port.in_waiting))
+            if final_result(response) is not None:
+                return response
+            if expect_prompt and response.rstrip(b' ').endswith(SMS_PROMPT):
+                return response
@@ -0,0 +1,141 @@
+""" benchmark.py - timings for the segment handling hot paths of the gateway.
+
+Usage: python benchmark.py
+"""
+import os
+import json
+import random
+import tempfile
+import time
+import timeit
+from segment_storage import SegmentStorage
+from persistent_segment_storage import PersistentSegmentStorage
+from txtenna_segment import TxTennaSegment, CBOR_ENCODING
+import cbor
+
+SEGMENT_COUNTS = [1, 10, 50, 100, 250, 500]
+LOSS_RATES = [0.0, 0.05, 0.1, 0.2, 0.3]
+PARITY_RATIOS = [0.0, 0.25, 0.5, 1.0]
+
+class ListSegmentStorage:
+    """ The original list based SegmentStorage.put/get_raw_tx, kept for comparison.
+    """
+    def __init__(self):
+        self.payloads = {}
+
+    def put(self, segment):
+        if segment.payload_id in self.payloads:
+            payload = self.payloads[segment.payload_id]
+            payload.append(segment)
+            if segment.sequence_num+1 != len(payload):
+                payload.sort(key=lambda p: p.sequence_num)
+        else:
+            self.payloads[segment.payload_id] = [segment]
+
+    def get_raw_tx(self, payload_id):
+        raw_tx = ""
+        for segment in self.payloads[payload_id]:
+            if segment.payload is not None:
+                raw_tx += segment.payload
+        return raw_tx
+
+def make_segments(payload_id, count):
+    segments = [TxTennaSegment(payload_id, "ab" * 90, sequence_num=n) for n in range(1, count)]
+    segments.insert(0, TxTennaSegment(payload_id, "ab" * 50, tx_hash="00" * 32, segment_count=count))
+    random.shuffle(segments)
+    return segments
+
+def reassemble_slots(segments):
+    storage = SegmentStorage()
+    for segment in segments:
+        storage.put(segment)
+    payload_id = segments[0].payload_id
+    return storage.get_raw_tx(storage.get(payload_id))
+
+def reassemble_list(segments):
+    storage = ListSegmentStorage()
+    for segment in segments:
+        storage.put(segment)
+    return storage.get_raw_tx(segments[0].payload_id)
+
+def bench_reassembly(repeat=5):
+    print("Reassembly of one payload, segments in random arrival order (ms)")
+    print("{:>9} {:>12} {:>12}".format("segments", "list+sort", "slots"))
+    for count in SEGMENT_COUNTS:
+        segments = make_segments("0123456789abcdef", count)
+        number = max(1, 2000 // count)
+        before = min(timeit.repeat(lambda: reassemble_list(segments), number=number, repeat=repeat)) / number
+        after = min(timeit.repeat(lambda: reassemble_slots(segments), number=number, repeat=repeat)) / number
+        print("{:>9} {:>12.3f} {:>12.3f}".format(count, before * 1000, after * 1000))
+
+def bench_warm_restart(payloads=2000, segments_per_payload=25):
+    print("Warm restart of the persistent segment log")
+    path = os.path.join(tempfile.mkdtemp(), "segments.log")
+    storage = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    for n in range(payloads):
+        # leave one segment out so every payload is still incomplete
+        for segment in make_segments("{:016x}".format(n), segments_per_payload)[1:]:
+            storage.put(segment)
+    storage.close()
+
+    start = time.perf_counter()
+    storage = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    elapsed = time.perf_counter() - start
+    print("{} segments of {} payloads restored in {:.3f} s".format(payloads * (segments_per_payload - 1), storage.stats()["payloads"], elapsed))
+    storage.close()
+    os.remove(path)
+
+def cbor_to_txtenna_json(protocol_msg):
+    """ The original TxTenna.cbor_to_txtenna_json without its prints, kept for comparison.
+    """
+    data = protocol_msg[24]
+    segment = protocol_msg[28] if 28 in protocol_msg else 0
+    if (segment == 0):
+        network = chr(protocol_msg[27]) if 27 in protocol_msg else 'm'
+        return json.dumps({"i": protocol_msg[30].hex(), "h": protocol_msg[31].hex(), "t": data.hex(), "n": network, "c": segment, "s": protocol_msg[29]})
+    return json.dumps({"i": protocol_msg[30].hex(), "t": data.hex(), "c": segment})
+
+def bench_cbor_ingest(count=1000):
+    print("Per segment ingest cost of a received CBOR segment (us)")
+    messages = [cbor.dumps({24: os.urandom(100), 28: n, 30: os.urandom(8)}) for n in range(1, count)]
+    messages.append(cbor.dumps({24: os.urandom(80), 27: ord('t'), 29: count, 30: os.urandom(8), 31: os.urandom(32)}))
+
+    def ingest_json():
+        for message in messages:
+            TxTennaSegment.deserialize_from_json(cbor_to_txtenna_json(cbor.loads(message)))
+
+    def ingest_cbor():
+        for message in messages:
+            TxTennaSegment.deserialize_from_cbor(cbor.loads(message))
+
+    before = min(timeit.repeat(ingest_json, number=1, repeat=5)) / count
+    after = min(timeit.repeat(ingest_cbor, number=1, repeat=5)) / count
+    print("{:>12} {:>12}".format("via JSON", "direct"))
+    print("{:>12.2f} {:>12.2f}".format(before * 1000000, after * 1000000))
+
+def bench_loss(length=1000, trials=200):
+    print("Completion of a {} byte payload without retransmission, by segment loss rate".format(length))
+    print("{:>7} {:>9} {:>9}".format("parity", "segments", "airtime") + "".join(["{:>7.0%}".format(loss) for loss in LOSS_RATES]))
+    raw = os.urandom(length)
+    for ratio in PARITY_RATIOS:
+        plan = TxTennaSegment.plan(length, "555555555", "00" * 32, 0, 'm', CBOR_ENCODING, parity_ratio=ratio)
+        segments = list(TxTennaSegment.segments_for_plan(plan, raw))
+        rates = []
+        for loss in LOSS_RATES:
+            completed = 0
+            for _ in range(trials):
+                storage = SegmentStorage()
+                for segment in segments:
+                    if random.random() >= loss:
+                        storage.put(segment)
+                if storage.is_complete(plan.payload_id) and storage.get_raw_tx(storage.get(plan.payload_id)) == raw:
+                    completed += 1
+            rates.append(completed / trials)
+        print("{:>7.2f} {:>9} {:>8.1f}s".format(ratio, len(segments), plan.airtime()) + "".join(["{:>7.0%}".format(rate) for rate in rates]))
+
+if __name__ == '__main__':
+    random.seed(1)
+    bench_reassembly()
+    bench_warm_restart()
+    bench_cbor_ingest()
+    bench_loss()
@@ -0,0 +1,87 @@
+'''
+A long-lived connection to the local bitcoind, shared by the gateway threads.
+'''
+
+import threading
+import http.client
+import bitcoin.rpc
+
+# bitcoind error code of a transaction that is not in the mempool or the txindex
+RPC_INVALID_ADDRESS_OR_KEY = -5
+
+class BitcoinRPC:
+    """ One bitcoin.rpc.Proxy reused for every call, instead of a new connection and a
+    new read of the cookie file or bitcoin.conf per call.
+
+    The proxy holds a single HTTP connection, so calls are serialized by a lock. It is
+    created on first use and, after a connection error, created again and the call
+    retried once.
+    """
+
+    def __init__(self, service_url=None, btc_conf_file=None, timeout=bitcoin.rpc.DEFAULT_HTTP_TIMEOUT):
+        self.service_url = service_url
+        self.btc_conf_file = btc_conf_file
+        self.timeout = timeout
+        self.__proxy = None
+        self.__lock = threading.Lock()
+        self.calls = 0
+        self.reconnects = 0
+
+    def __connect(self):
+        if self.__proxy is None:
+            self.__proxy = bitcoin.rpc.Proxy(service_url=self.service_url, btc_conf_file=self.btc_conf_file, timeout=self.timeout)
+        return self.__proxy
+
+    def __disconnect(self):
+        if self.__proxy is not None:
+            try:
+                self.__proxy.close()
+            except Exception: # pylint: disable=broad-except
+                pass
+            self.__proxy = None
+
+    def __run(self, fn):
+        with self.__lock:
+            self.calls += 1
+            try:
+                return fn(self.__connect())
+            except (OSError, http.client.HTTPException):
+                ## the connection was dropped, eg. because bitcoind restarted
+                self.__disconnect()
+                self.reconnects += 1
+            return fn(self.__connect())
+
+    def call(self, method, *args):
+        """ Call a bitcoin.rpc.Proxy method, eg. call('getbalance')
+        """
+        return self.__run(lambda proxy: getattr(proxy, method)(*args))
+
+    def getrawtransactions(self, txids):
+        """ Verbose getrawtransaction of every txid (hex) in a single JSON-RPC batch request.
+        Returns the result dicts by txid, transactions bitcoind does not know are left out.
+        """
+        if len(txids) == 0:
+            return {}
+        rpc_calls = [{'version': '1.1', 'method': 'getrawtransaction', 'params': [txid, 1], 'id': n} for n, txid in enumerate(txids)]
+        responses = self.__run(lambda proxy: proxy._batch(rpc_calls))
+
+        results = {}
+        for response in responses:
+            error = response.get('error')
+            if error is None and response.get('result') is not None:
+                results[txids[response['id']]] = response['result']
+            elif isinstance(error, dict) and error.get('code') != RPC_INVALID_ADDRESS_OR_KEY:
+                print("getrawtransaction " + txids[response['id']] + " failed: " + str(error.get('message')))
+        return results
+
+    def getblockproofdata(self, block_hash):
+        """ Header (bytes), height and transaction ids (hex) of a block, from one JSON-RPC batch request
+        """
+        rpc_calls = [{'version': '1.1', 'method': 'getblock', 'params': [block_hash, 1], 'id': 0},
+                     {'version': '1.1', 'method': 'getblockheader', 'params': [block_hash, False], 'id': 1}]
+        responses = sorted(self.__run(lambda proxy: proxy._batch(rpc_calls)), key=lambda response: response['id'])
+        for response in responses:
+            if response.get('error') is not None:
+                raise bitcoin.rpc.JSONRPCError(response['error'])
+        block = responses[0]['result']
+        return (bytes.fromhex(responses[1]['result']), block['height'], block['tx'])
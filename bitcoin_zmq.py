@@ -0,0 +1,81 @@
+'''
+Confirmation news pushed by the local bitcoind over ZMQ, so replies go out as soon
+as a transaction is seen rather than at the next poll.
+
+bitcoind must be started with one or more of -zmqpubrawtx, -zmqpubhashblock and
+-zmqpubsequence pointing at the addresses given here.
+'''
+
+import threading
+import traceback
+import zmq
+from bitcoin.core import CTransaction, b2lx
+
+ZMQ_TOPICS = (b'rawtx', b'hashblock', b'sequence')
+
+# labels of sequence notifications
+SEQUENCE_BLOCK_CONNECTED = 'C'
+SEQUENCE_TX_ADDED = 'A'
+
+class BitcoinZMQListener:
+    """ Subscribe to the rawtx, hashblock and sequence notifications of bitcoind and pass
+    what they tell about pending transactions to a ConfirmationScheduler.
+
+    A transaction in a rawtx notification, or added to the mempool in a sequence
+    notification, is reported as in the mempool straight away. A new block makes
+    every pending transaction due for a poll, which finds its confirmations.
+    """
+
+    def __init__(self, scheduler, addresses, context=None):
+        self.scheduler = scheduler
+        self.addresses = addresses
+        self.context = context if context is not None else zmq.Context.instance()
+        self.notifications = 0
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def run(self):
+        socket = self.context.socket(zmq.SUB)
+        try:
+            for address in self.addresses:
+                socket.connect(address)
+            for topic in ZMQ_TOPICS:
+                socket.setsockopt(zmq.SUBSCRIBE, topic)
+            while self.__running:
+                ## wake up now and then to notice stop
+                if socket.poll(1000) == 0:
+                    continue
+                parts = socket.recv_multipart()
+                try:
+                    self.handle(parts[0], parts[1])
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
+        finally:
+            socket.close(linger=0)
+
+    def handle(self, topic, body):
+        self.notifications += 1
+        if topic == b'rawtx':
+            self.scheduler.update(b2lx(CTransaction.deserialize(body).GetTxid()), 0)
+        elif topic == b'hashblock':
+            self.scheduler.poll_now()
+        elif topic == b'sequence':
+            ## 32 byte hash in the byte order it is displayed in, a label and for mempool events a sequence number
+            label = chr(body[32])
+            if label == SEQUENCE_TX_ADDED:
+                self.scheduler.update(body[:32].hex(), 0)
+            elif label == SEQUENCE_BLOCK_CONNECTED:
+                self.scheduler.poll_now()
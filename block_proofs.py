@@ -0,0 +1,123 @@
+'''
+Merkle proofs that a transaction is in a block, for mesh clients to check a
+confirmation offline against the block header.
+
+The header, height and transaction ids of recent blocks are cached, so every
+confirmation in the same block costs one lookup of the block and the proof
+itself is computed locally.
+
+A proof is the CBOR map {MERKLE_INDEX_CBOR_TAG: index of the transaction in the
+block, MERKLE_BRANCH_CBOR_TAG: the hashes of the branch joined in one byte string,
+BLOCK_HEADER_CBOR_TAG: the 80 byte block header}. Hashes are in the byte order
+they are hashed in, the reverse of the hex form.
+'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+import cbor
+
+MERKLE_INDEX_CBOR_TAG = 34
+MERKLE_BRANCH_CBOR_TAG = 35
+BLOCK_HEADER_CBOR_TAG = 36
+
+DEFAULT_MAX_BLOCKS = 16
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def merkle_branch(hashes, index):
+    """ The sibling hashes from the leaf at index up to the merkle root of hashes
+    """
+    branch = []
+    level = list(hashes)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        branch.append(level[index ^ 1])
+        level = [double_sha256(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        index //= 2
+    return branch
+
+def merkle_root_from_branch(leaf, index, branch):
+    root = leaf
+    for sibling in branch:
+        root = double_sha256(sibling + root) if index & 1 else double_sha256(root + sibling)
+        index //= 2
+    return root
+
+def encode_proof(index, branch, header):
+    return cbor.dumps({
+        MERKLE_INDEX_CBOR_TAG: index,
+        MERKLE_BRANCH_CBOR_TAG: b''.join(branch),
+        BLOCK_HEADER_CBOR_TAG: header
+    })
+
+def verify_proof(tx_hash, proof):
+    """ Check an encoded proof for the transaction with hex tx_hash, returns the
+    header it was checked against or None if the proof does not hold
+    """
+    try:
+        fields = cbor.loads(bytes(proof))
+        index = fields[MERKLE_INDEX_CBOR_TAG]
+        branch_bytes = fields[MERKLE_BRANCH_CBOR_TAG]
+        header = fields[BLOCK_HEADER_CBOR_TAG]
+        if len(header) != 80 or len(branch_bytes) % 32 != 0:
+            return None
+    except (KeyError, TypeError, ValueError, RuntimeError):
+        ## the cbor C extension raises RuntimeError on some malformed input
+        return None
+    branch = [branch_bytes[i:i + 32] for i in range(0, len(branch_bytes), 32)]
+    leaf = bytes.fromhex(tx_hash)[::-1]
+    ## the merkle root follows the version and previous block hash in the header
+    if merkle_root_from_branch(leaf, index, branch) != header[36:68]:
+        return None
+    return header
+
+class BlockProofCache:
+    """ LRU of the last max_blocks blocks proofs were asked for. fetch(block_hash) returns
+    the (header, height, txids) of a block, with its transaction ids in hex.
+    """
+
+    def __init__(self, fetch, max_blocks=DEFAULT_MAX_BLOCKS):
+        self.fetch = fetch
+        self.max_blocks = max_blocks
+        self.__blocks = OrderedDict()
+        self.__lock = threading.Lock()
+        self.fetches = 0
+        self.proofs = 0
+
+    def block(self, block_hash):
+        """ Returns the cached (header, height, leaves, index by txid) of a block
+        """
+        with self.__lock:
+            block = self.__blocks.get(block_hash)
+            if block is not None:
+                self.__blocks.move_to_end(block_hash)
+                return block
+            ## looked up under the lock, so confirmations in the same block wait for one fetch
+            (header, height, txids) = self.fetch(block_hash)
+            self.fetches += 1
+            block = (bytes(header), height, [bytes.fromhex(txid)[::-1] for txid in txids],
+                     dict([(txid, index) for index, txid in enumerate(txids)]))
+            self.__blocks[block_hash] = block
+            while len(self.__blocks) > self.max_blocks:
+                self.__blocks.popitem(last=False)
+            return block
+
+    def proof(self, tx_hash, block_hash):
+        """ Returns the (height, encoded proof) of a transaction in a block, None if it is not in it
+        """
+        (header, height, leaves, indexes) = self.block(block_hash)
+        index = indexes.get(tx_hash)
+        if index is None:
+            return None
+        self.proofs += 1
+        return (height, encode_proof(index, merkle_branch(leaves, index), header))
+
+    def stats(self):
+        return {
+            "blocks": len(self.__blocks),
+            "fetches": self.fetches,
+            "proofs": self.proofs
+        }
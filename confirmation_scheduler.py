@@ -0,0 +1,176 @@
+'''
+Track broadcast transactions until they are confirmed, from a single thread.
+
+Transactions are polled on a shared cadence: whenever some are due, all of them
+are passed to check(trackers) at once, which returns the block of each one it
+found by transaction hash, 0 while it is only in the mempool. notify(tracker, block)
+is called when a transaction first shows up in the mempool (block 0), when it is
+confirmed (block > 0) and when it was not confirmed before the timeout (block None).
+
+Besides polling, news pushed by bitcoind can be passed in with update (a transaction
+was seen) and poll_now (a block was connected).
+'''
+
+import time
+import heapq
+import threading
+import traceback
+
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_TIMEOUT = 60 * 60
+
+class ConfirmationTracker:
+    """ A transaction waiting for confirmation and the GIDs to tell about it
+    """
+
+    def __init__(self, tx_hash, network, deadline):
+        self.tx_hash = tx_hash
+        self.network = network
+        self.gids = set()
+        self.in_mempool = False
+        self.block = None
+        self.block_hash = None
+        self.deadline = deadline
+
+class ConfirmationScheduler:
+    def __init__(self, check, notify, poll_interval=DEFAULT_POLL_INTERVAL, timeout=DEFAULT_TIMEOUT):
+        self.check = check
+        self.notify = notify
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.__trackers = {}
+        self.__due = []
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__thread = None
+        self.polls = 0
+        self.confirmed = 0
+        self.timed_out = 0
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def track(self, tx_hash, gid=None, network=None):
+        """ Start tracking a transaction, or add gid to the ones told about it if it is
+        already tracked. The first poll is due straight away. Returns the tracker.
+        """
+        with self.__condition:
+            tracker = self.__trackers.get(tx_hash)
+            if tracker is None:
+                now = time.monotonic()
+                tracker = self.__trackers[tx_hash] = ConfirmationTracker(tx_hash, network, now + self.timeout)
+                heapq.heappush(self.__due, (now, tx_hash))
+                self.__condition.notify()
+            if gid is not None:
+                tracker.gids.add(gid)
+            return tracker
+
+    def get(self, tx_hash):
+        return self.__trackers.get(tx_hash)
+
+    def update(self, tx_hash, block):
+        """ Apply the block of a transaction learned without polling, eg. 0 when it was
+        announced in the mempool. Returns False if the transaction is not tracked.
+        """
+        tracker = self.__trackers.get(tx_hash)
+        if tracker is None:
+            return False
+        self.__apply(tracker, block, None)
+        return True
+
+    def poll_now(self):
+        """ Make every pending transaction due for a poll, eg. because a block was connected
+        """
+        with self.__condition:
+            now = time.monotonic()
+            self.__due = [(now, tx_hash) for (_, tx_hash) in self.__due]
+            heapq.heapify(self.__due)
+            self.__condition.notify()
+
+    def pending(self):
+        """ Number of transactions waiting for confirmation
+        """
+        return len(self.__trackers)
+
+    def stats(self):
+        return {
+            "pending": len(self.__trackers),
+            "polls": self.polls,
+            "confirmed": self.confirmed,
+            "timed_out": self.timed_out
+        }
+
+    def run(self):
+        while True:
+            with self.__condition:
+                while self.__running and (len(self.__due) == 0 or self.__due[0][0] > time.monotonic()):
+                    self.__condition.wait(self.__due[0][0] - time.monotonic() if self.__due else None)
+                if not self.__running:
+                    return
+                now = time.monotonic()
+                due = []
+                while self.__due and self.__due[0][0] <= now:
+                    tracker = self.__trackers.get(heapq.heappop(self.__due)[1])
+                    if tracker is not None:
+                        due.append(tracker)
+            if due:
+                self.poll(due)
+
+    def poll(self, trackers):
+        """ Check the given trackers once and reschedule the ones still pending
+        """
+        try:
+            blocks = self.check(trackers)
+        except Exception:
+            traceback.print_exc()
+            blocks = {}
+        self.polls += 1
+
+        now = time.monotonic()
+        for tracker in trackers:
+            if self.__apply(tracker, blocks.get(tracker.tx_hash), now):
+                with self.__condition:
+                    heapq.heappush(self.__due, (now + self.poll_interval, tracker.tx_hash))
+
+    def __apply(self, tracker, block, now):
+        """ Move a tracker on with the block found for it and send the notifications that
+        are due. Deadlines are only checked when now is given. Returns True while it is pending.
+        """
+        notifications = []
+        with self.__condition:
+            if self.__trackers.get(tracker.tx_hash) is not tracker:
+                ## already finished, eg. by an update while it was being polled
+                return False
+            if block is not None and not tracker.in_mempool:
+                tracker.in_mempool = True
+                notifications.append(0)
+            if block is not None and block > 0:
+                tracker.block = block
+                del self.__trackers[tracker.tx_hash]
+                self.confirmed += 1
+                notifications.append(block)
+            elif now is not None and now >= tracker.deadline:
+                del self.__trackers[tracker.tx_hash]
+                self.timed_out += 1
+                notifications.append(None)
+            pending = tracker.tx_hash in self.__trackers
+
+        for notification in notifications:
+            try:
+                self.notify(tracker, notification)
+            except Exception:
+                traceback.print_exc()
+        return pending
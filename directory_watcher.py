@@ -0,0 +1,200 @@
+'''
+Watch a directory for new files, eg. message data written by the blocksat receiver.
+
+On Linux the directory is watched with inotify and a file is picked up as soon as
+the program writing it closes it, or it is moved into the directory. Elsewhere,
+or if inotify can not be set up, the directory is scanned every poll_interval
+seconds and a file is picked up once its size and modification time did not
+change between two scans.
+
+Files that were handled are recorded in an index file, so they are not handled
+again after a restart unless they are rewritten. A file on_file failed for is
+not recorded, and is tried again by the next scan or when it is rewritten.
+'''
+
+import os
+import json
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import traceback
+
+DEFAULT_POLL_INTERVAL = 10
+
+# name of the index file kept in the watched directory
+DEFAULT_INDEX_NAME = '.broadcast_index'
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def is_partial(filename):
+    """ Hidden and temporary files are still being written, or not meant to be picked up
+    """
+    return filename.startswith('.') or filename.endswith(('.tmp', '.part', '~'))
+
+class Inotify:
+    """ Minimal ctypes binding of the Linux inotify API
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__add_watch = libc.inotify_add_watch
+        self.__add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.__add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + path)
+        return wd
+
+    def read(self, timeout):
+        """ Returns the (mask, name) of the events that arrived within timeout seconds
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher:
+    """ Call on_file(directory, filename) once for every complete file that shows up in directory
+    """
+
+    def __init__(self, directory, on_file, index_path=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.directory = directory
+        self.on_file = on_file
+        self.index_path = index_path if index_path is not None else os.path.join(directory, DEFAULT_INDEX_NAME)
+        self.poll_interval = poll_interval
+        self.__index = {}
+        self.__index_file = None
+        self.__load_index()
+
+    def __load_index(self):
+        """ Read the index of handled files, dropping the ones no longer in the directory
+        """
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.__index[record["f"]] = (record["s"], record["m"])
+                    except (ValueError, KeyError):
+                        continue
+        present = set(os.listdir(self.directory)) if os.path.isdir(self.directory) else set()
+        live = dict([(name, key) for name, key in self.__index.items() if name in present])
+        if len(live) != len(self.__index):
+            self.__index = live
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines([self.__index_record(name, key) for name, key in live.items()])
+            os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def __index_record(name, key):
+        return json.dumps({"f": name, "s": key[0], "m": key[1]}, separators=(',',':')) + '\n'
+
+    def __key(self, filename):
+        st = os.stat(os.path.join(self.directory, filename))
+        return (st.st_size, st.st_mtime_ns)
+
+    def is_handled(self, filename):
+        try:
+            return self.__index.get(filename) == self.__key(filename)
+        except OSError:
+            return True
+
+    def handle(self, filename):
+        """ Pass a complete file to on_file unless that version of it was handled before
+        """
+        if is_partial(filename) or self.is_handled(filename):
+            return
+        path = os.path.join(self.directory, filename)
+        if not os.path.isfile(path):
+            return
+        key = self.__key(filename)
+        try:
+            self.on_file(self.directory, filename)
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+            return
+        self.__index[filename] = key
+        if self.__index_file is None:
+            self.__index_file = open(self.index_path, 'a')
+        self.__index_file.write(self.__index_record(filename, key))
+        self.__index_file.flush()
+
+    def run(self):
+        """ Watch until the directory is removed
+        """
+        try:
+            inotify = Inotify()
+            inotify.add_watch(self.directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+        except (OSError, AttributeError):
+            ## not Linux, or out of inotify watches
+            self.poll()
+            return
+
+        try:
+            ## files written while the gateway was down, or still being written when it started,
+            ## are scanned every poll_interval seconds until they were handled
+            pending = self.scan({})
+            scanned = time.monotonic()
+            while os.path.exists(self.directory):
+                for (mask, name) in inotify.read(self.poll_interval):
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        return
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self.handle(name)
+                        if not is_partial(name) and not self.is_handled(name):
+                            ## on_file failed, try again with the scans
+                            pending[name] = None
+                if len(pending) > 0 and time.monotonic() - scanned >= self.poll_interval:
+                    pending = self.scan(pending)
+                    scanned = time.monotonic()
+        finally:
+            inotify.close()
+
+    def scan(self, before):
+        """ Handle the files that did not change since the scan that returned before,
+        returns the (size, modification time) of the files not handled yet
+        """
+        after = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if is_partial(filename) or self.is_handled(filename):
+                continue
+            try:
+                after[filename] = self.__key(filename)
+            except OSError:
+                continue
+            ## only files that did not change since the last scan are complete
+            if before.get(filename) == after[filename]:
+                self.handle(filename)
+        return dict([(name, key) for name, key in after.items() if not self.is_handled(name)])
+
+    def poll(self):
+        """ Fallback that scans the directory every poll_interval seconds
+        """
+        before = {}
+        while os.path.exists(self.directory):
+            before = self.scan(before)
+            time.sleep(self.poll_interval)
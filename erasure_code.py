@@ -0,0 +1,111 @@
+'''
+Systematic Reed-Solomon erasure code over GF(256) with a Cauchy generator matrix.
+
+The data shards are sent as they are, followed by parity shards. Any data_count
+of the data_count + parity_count shards are enough to rebuild the data shards.
+All shards must have the same length and data_count + parity_count may not
+exceed MAX_SHARD_COUNT.
+'''
+
+MAX_SHARD_COUNT = 256
+
+## log and antilog tables of GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+## multiplying a whole shard by a constant is a bytes.translate with its row of this table
+MUL_TABLES = [bytes([gf_mul(c, v) for v in range(256)]) for c in range(256)]
+
+def cauchy(parity_num, data_num, data_count):
+    """ Coefficient of data shard data_num in parity shard parity_num, 1 / (x + y) with
+    x = data_count + parity_num and y = data_num, which are always distinct
+    """
+    return gf_inv((data_count + parity_num) ^ data_num)
+
+def _mul_add(acc, coefficient, shard):
+    ## acc + coefficient * shard, with the shards held as little endian integers so adding is a single xor
+    if coefficient == 0:
+        return acc
+    return acc ^ int.from_bytes(bytes(shard).translate(MUL_TABLES[coefficient]), 'little')
+
+def encode(shards, parity_count):
+    """ Returns parity_count parity shards for the equal length data shards
+    """
+    data_count = len(shards)
+    if data_count + parity_count > MAX_SHARD_COUNT:
+        raise ValueError("At most " + str(MAX_SHARD_COUNT) + " shards are supported")
+    size = len(shards[0]) if data_count > 0 else 0
+    parity = []
+    for parity_num in range(parity_count):
+        acc = 0
+        for data_num, shard in enumerate(shards):
+            acc = _mul_add(acc, cauchy(parity_num, data_num, data_count), shard)
+        parity.append(acc.to_bytes(size, 'little'))
+    return parity
+
+def _invert(matrix):
+    """ Invert a square matrix over GF(256) by Gauss-Jordan elimination
+    """
+    n = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col] != 0)
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inverse = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inverse, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor != 0:
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+def decode(shards, data_count, parity_count):
+    """ Rebuild the data shards from a dict of shard number to shard, where data shards are
+    numbered from 0 and parity shards from data_count. Returns the data_count data shards,
+    raises ValueError if fewer than data_count shards are given.
+    """
+    missing = [data_num for data_num in range(data_count) if data_num not in shards]
+    if len(missing) == 0:
+        return [bytes(shards[data_num]) for data_num in range(data_count)]
+
+    parity_nums = [parity_num for parity_num in range(parity_count) if data_count + parity_num in shards][:len(missing)]
+    if len(parity_nums) < len(missing):
+        raise ValueError("Need " + str(data_count) + " shards to rebuild the data, got " + str(len(shards)))
+    size = len(shards[data_count + parity_nums[0]])
+
+    ## remove the known data shards from the parity shards, what is left only depends on the missing ones
+    remainders = []
+    for parity_num in parity_nums:
+        acc = int.from_bytes(bytes(shards[data_count + parity_num]), 'little')
+        for data_num in range(data_count):
+            if data_num in shards:
+                acc = _mul_add(acc, cauchy(parity_num, data_num, data_count), shards[data_num])
+        remainders.append(acc.to_bytes(size, 'little'))
+
+    ## every square submatrix of a Cauchy matrix is invertible
+    inverse = _invert([[cauchy(parity_num, data_num, data_count) for data_num in missing] for parity_num in parity_nums])
+    recovered = {}
+    for row, data_num in enumerate(missing):
+        acc = 0
+        for coefficient, remainder in zip(inverse[row], remainders):
+            acc = _mul_add(acc, coefficient, remainder)
+        recovered[data_num] = acc.to_bytes(size, 'little')
+
+    return [bytes(shards[data_num]) if data_num in shards else recovered[data_num] for data_num in range(data_count)]
@@ -0,0 +1,130 @@
+'''
+Hand events from the goTenna driver thread over to a pool of worker threads, so
+the driver can deliver the next event while slow handlers, eg. ones talking to
+the serial modem, still run.
+'''
+
+import time
+import queue
+import threading
+import traceback
+from collections import deque
+
+DEFAULT_WORKER_COUNT = 2
+DEFAULT_MAX_QUEUED = 100
+
+class EventKind:
+    """ The handler and bounded queue of one kind of event, with its counters
+    """
+
+    def __init__(self, name, handler, max_queued):
+        self.name = name
+        self.handler = handler
+        self.max_queued = max_queued
+        self.items = deque()
+        self.scheduled = False
+        self.dispatched = 0
+        self.dropped = 0
+        self.handled = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def stats(self):
+        handled = max(self.handled, 1)
+        return {
+            "queued": len(self.items),
+            "max_queued": self.max_depth,
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+            "handled": self.handled,
+            "failed": self.failed,
+            "avg_wait_ms": round(self.wait_time * 1000 / handled, 1),
+            "avg_run_ms": round(self.run_time * 1000 / handled, 1),
+            "max_run_ms": round(self.max_run_time * 1000, 1)
+        }
+
+class EventDispatcher:
+    """ Per kind queues of events drained by worker_count threads.
+
+    dispatch only appends to the queue of the kind and never blocks, an event that
+    finds its queue holding max_queued events is dropped and counted. A queue bound
+    of 1 coalesces bursts, eg. of status events that all trigger the same check.
+    Events of one kind are handled one at a time and in order, by whichever worker
+    is free, while events of other kinds are handled next to them.
+    """
+
+    def __init__(self, worker_count=DEFAULT_WORKER_COUNT):
+        self.worker_count = worker_count
+        self.__kinds = {}
+        self.__ready = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__threads = []
+
+    def register(self, name, handler, max_queued=DEFAULT_MAX_QUEUED):
+        """ Handle events dispatched as name with handler(item)
+        """
+        self.__kinds[name] = EventKind(name, handler, max_queued)
+
+    def start(self):
+        while len(self.__threads) < self.worker_count:
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        for _ in self.__threads:
+            self.__ready.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def dispatch(self, name, item=None):
+        """ Queue an event for the workers, returns False if it was dropped
+        """
+        kind = self.__kinds[name]
+        with self.__lock:
+            kind.dispatched += 1
+            if len(kind.items) >= kind.max_queued:
+                kind.dropped += 1
+                return False
+            kind.items.append((time.monotonic(), item))
+            kind.max_depth = max(kind.max_depth, len(kind.items))
+            if kind.scheduled:
+                return True
+            kind.scheduled = True
+        self.__ready.put(kind)
+        return True
+
+    def depth(self):
+        return sum([len(kind.items) for kind in self.__kinds.values()])
+
+    def stats(self):
+        return dict([(name, kind.stats()) for name, kind in self.__kinds.items()])
+
+    def run(self):
+        while True:
+            kind = self.__ready.get()
+            if kind is None:
+                return
+            with self.__lock:
+                (queued, item) = kind.items.popleft()
+            started = time.monotonic()
+            try:
+                kind.handler(item)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                kind.failed += 1
+            finished = time.monotonic()
+            with self.__lock:
+                kind.handled += 1
+                kind.wait_time += started - queued
+                kind.run_time += finished - started
+                kind.max_run_time = max(kind.max_run_time, finished - started)
+                ## one event at a time per kind, the next one goes to the back of the line
+                if len(kind.items) == 0:
+                    kind.scheduled = False
+                    continue
+            self.__ready.put(kind)
@@ -24,6 +24,8 @@ import json
 import configparser
 from threading import Thread
 from datetime import datetime, timedelta
+from event_dispatcher import EventDispatcher
+from at_command import ATCommandEngine, is_error
 
 BYTE_STRING_CBOR_TAG = 24
 PHONE_NUMBER_CBOR_TAG = 25
@@ -42,6 +44,12 @@ SPI_READY = 27
 DEFAULT_BUF_SIZE = 6000
 MESH_PAYLOAD_SIZE = 150
 
+# seconds the SMS modem may take to answer, by command. Submitting an SMS waits for the network.
+AT_COMMAND_TIMEOUT = 2
+AT_ENABLE_MODEM_TIMEOUT = 10
+AT_READ_SMS_TIMEOUT = 10
+AT_SEND_SMS_TIMEOUT = 60
+
 # Configure the Python logging module to print to stderr. In your application,
 # you may want to route the logging elsewhere.
 logging.basicConfig()
@@ -110,6 +118,7 @@ class goTennaCLI(cmd.Cmd):
         self.serial_rate = 115200
         self.sms_sender_dict = {}
         self.serial = None
+        self.at_commands = None
 
         # imeshyou information
         self.email = ''
@@ -128,6 +137,13 @@ class goTennaCLI(cmd.Cmd):
         # prevent threads from accessing serial port simultaneiously
         self.serial_lock = threading.Lock() 
 
+        # slow work triggered by driver events runs on worker threads, so the driver thread
+        # can deliver the next event right away. Status events are coalesced while a read is pending.
+        self.event_dispatcher = EventDispatcher()
+        self.event_dispatcher.register('sms', self.handle_sms_request)
+        self.event_dispatcher.register('status', self.handle_status, max_queued=1)
+        self.event_dispatcher.start()
+
     def precmd(self, line):
         if not self.api_thread\
            and not line.startswith('sdk_token')\
@@ -163,7 +179,8 @@ class goTennaCLI(cmd.Cmd):
 
         See the documentation for ``goTenna.driver``.
 
-        This will be invoked from the API's thread when events are received.
+        This will be invoked from the API's thread when events are received, anything
+        slow is handed over to the event dispatcher.
         """
         if evt.event_type == goTenna.driver.Event.MESSAGE:
             try:
@@ -172,8 +189,8 @@ class goTennaCLI(cmd.Cmd):
                     if PHONE_NUMBER_CBOR_TAG in protocol_msg:
                         phone_number = str(protocol_msg[PHONE_NUMBER_CBOR_TAG])
                         text_message = protocol_msg[MESSAGE_TEXT_CBOR_TAG]
-                        self.do_send_sms("+" + phone_number + " " + text_message)
-                        self.sms_sender_dict[phone_number.encode()] = str(evt.message.sender.gid_val).encode()
+                        if not self.event_dispatcher.dispatch('sms', (phone_number, text_message, evt.message.sender.gid_val)):
+                            print("SMS queue full, dropped message to +" + phone_number)
                 elif type(evt.message.payload) == goTenna.payload.CustomPayload:
                     print("Unknown BinaryPayload.")
                 else:
@@ -210,7 +227,7 @@ class goTennaCLI(cmd.Cmd):
             self.status = evt.status
             if self.serial != None:
                 # check for unread SMS messages
-                self.do_read_sms("", self.forward_to_mesh)
+                self.event_dispatcher.dispatch('status')
 
         elif evt.event_type == goTenna.driver.Event.GROUP_CREATE:
             index = -1
@@ -222,6 +239,25 @@ class goTennaCLI(cmd.Cmd):
                   .format(evt.group.gid.gid_val,
                           index))
 
+    def handle_sms_request(self, request):
+        """ Send the SMS a mesh node asked for, called by the event dispatcher
+        """
+        (phone_number, text_message, sender_gid) = request
+        self.do_send_sms("+" + phone_number + " " + text_message)
+        self.sms_sender_dict[phone_number.encode()] = str(sender_gid).encode()
+
+    def handle_status(self, item):
+        """ Forward unread SMS messages to the mesh, called by the event dispatcher
+        """
+        self.do_read_sms("", self.forward_to_mesh)
+
+    def do_event_stats(self, rem):
+        """ Show the queue depth and handler latency of each kind of event.
+
+        Usage: event_stats
+        """
+        print(str(self.event_dispatcher.stats()))
+
     def do_set_gid(self, rem):
         """ Create a new profile (if it does not already exist) with default settings.
 
@@ -451,6 +487,48 @@ class goTennaCLI(cmd.Cmd):
                 return
             self.in_flight_events[corr_id.bytes] = 'Broadcast message: {}'.format(message)
 
+    def send_broadcast_binary(self, data):
+        """ Send binary data, eg. a CBOR encoded segment, as a broadcast message
+        """
+        if not self.api_thread.connected:
+            print("No device connected")
+        else:
+            try:
+                method_callback = build_callback(self.in_flight_events)
+                payload = goTenna.payload.BinaryPayload(data)
+                corr_id = self.api_thread.send_broadcast(payload,
+                                                         method_callback)
+            except ValueError:
+                print("Message too long!")
+                return
+            self.in_flight_events[corr_id.bytes] = 'Broadcast binary message: {} bytes'.format(len(data))
+
+    def send_private_binary(self, gid, data):
+        """ Send binary data, eg. a CBOR encoded merkle proof segment, as a private message to gid
+        """
+        if not self.api_thread.connected:
+            print("No device connected")
+            return
+        (gidobj, _) = self._parse_gid(str(gid), goTenna.settings.GID.PRIVATE)
+        if not gidobj:
+            return
+        try:
+            method_callback = build_callback(self.in_flight_events)
+            payload = goTenna.payload.BinaryPayload(data)
+            def ack_callback(correlation_id, success):
+                if not success:
+                    print("Private binary message to {}: delivery not confirmed, recipient may be offline or out of range"
+                          .format(gidobj.gid_val))
+            corr_id = self.api_thread.send_private(gidobj, payload,
+                                                   method_callback,
+                                                   ack_callback=ack_callback,
+                                                   encrypt=self._do_encryption)
+        except ValueError:
+            print("Message too long!")
+            return
+        self.in_flight_events[corr_id.bytes]\
+            = 'Private binary message to {}: {} bytes'.format(gidobj.gid_val, len(data))
+
     @staticmethod
     def _parse_gid(line, gid_type, print_message=True):
         parts = line.split(' ')
@@ -824,21 +902,10 @@ class goTennaCLI(cmd.Cmd):
             print("Device must be connected")
         print(self.api_thread.system_info)
 
-    def send_ser_command(self, command):
-        self.serial.write(command)
-        sleep(0.5)
-        ret = b''
-        n = self.serial.in_waiting
-        while True:
-            if n > 0:
-                ret += self.serial.read(n)
-            else:
-                sleep(.5)
-            n = self.serial.in_waiting
-            if n == 0:
-                break
-
-        return ret
+    def send_ser_command(self, command, timeout=AT_COMMAND_TIMEOUT, expect_prompt=False):
+        """ Send an AT command and return the response as soon as the modem finished it
+        """
+        return self.at_commands.command(command, timeout, expect_prompt)
 
     def do_send_sms(self, args):
         """ Send an SMS message to a particular phone number.
@@ -860,9 +927,14 @@ class goTennaCLI(cmd.Cmd):
             print ("Message: ", message)
 
             with self.serial_lock:
-                # send SMS message
-                self.send_ser_command(SEND_SMS % phone_number.encode())
-                self.send_ser_command(message.encode()+SEND_CLOSE)
+                # send SMS message once the modem prompts for its text
+                ret = self.send_ser_command(SEND_SMS % phone_number.encode(), expect_prompt=True)
+                if is_error(ret):
+                    print("SMS to {} refused: {}".format(phone_number, ret.strip()))
+                    return
+                ret = self.send_ser_command(message.encode()+SEND_CLOSE, AT_SEND_SMS_TIMEOUT)
+                if is_error(ret):
+                    print("SMS to {} failed: {}".format(phone_number, ret.strip()))
 
         except serial.SerialTimeoutException:
             print("SerialTimeoutException")
@@ -905,10 +977,11 @@ class goTennaCLI(cmd.Cmd):
         try:
             with self.serial_lock:
                 # retrieve all unread SMS messages
-                ret = self.send_ser_command(RETRIEVE_UNREAD)
+                ret = self.send_ser_command(RETRIEVE_UNREAD, AT_READ_SMS_TIMEOUT)
 
         except serial.SerialTimeoutException:
             print("SerialTimeoutException")
+            return
 
         lines = [line for line in ret.split(b'\r\n') if line.strip() != b'']
 
@@ -956,6 +1029,7 @@ class goTennaCLI(cmd.Cmd):
 
         if self.serial == None:
             self.serial = serial.Serial(self.serial_port, self.serial_rate, write_timeout=2)
+            self.at_commands = ATCommandEngine(self.serial)
 
         OPERATE_SMS_MODE = b'AT+CMGF=1\r'
         ECHO_MODE = b'ATE1\r'
@@ -972,7 +1046,7 @@ class goTennaCLI(cmd.Cmd):
                 # Set echo mode
                 self.send_ser_command(ECHO_MODE)
                 # Make sure modem is enabled
-                self.send_ser_command(ENABLE_MODEM)
+                self.send_ser_command(ENABLE_MODEM, AT_ENABLE_MODEM_TIMEOUT)
                 # Store SMS messages received on the modem
                 self.send_ser_command(SMS_STORAGE)
                 # Disable unsolicited message indicators
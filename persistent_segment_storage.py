@@ -0,0 +1,203 @@
+'''
+ConcurrentSegmentStorage backed by an append-only segment log, so partially received
+payloads survive a gateway restart.
+
+Each line of the log is either a put record ("+" followed by the segment JSON,
+preceded by the encoding of its data and a space unless that is hex) or a
+remove record ("-" followed by the payload id). Records are flushed to the
+OS as they are written and fsync'd in batches. On startup the log is replayed
+to rebuild the in-memory index. The log is compacted on startup and, once it
+holds at least COMPACT_MIN_RECORDS records, whenever most of it is dead records.
+A compacted log is written from the segments in memory, only the number of live
+records of each payload is kept next to them.
+Payloads that were already complete in the log are passed to on_complete again,
+with a context of None, by replay_completed. It is left to the owner to call it
+once it is ready to handle them.
+'''
+
+import os
+import time
+import threading
+import json
+from segment_storage import SegmentStorage, ConcurrentSegmentStorage, DEFAULT_MAX_BYTES, DEFAULT_TTL
+from txtenna_segment import TxTennaSegment, HEX_ENCODING
+
+PUT_RECORD = '+'
+REMOVE_RECORD = '-'
+
+# smallest log that is compacted while the gateway runs
+COMPACT_MIN_RECORDS = 1024
+
+def put_record(segment):
+    if segment.encoding == HEX_ENCODING:
+        return PUT_RECORD + segment.serialize_to_json() + '\n'
+    ## the JSON form does not tell the Z85 or text encoded data of a segment from hex
+    return PUT_RECORD + segment.encoding + ' ' + segment.serialize_to_json() + '\n'
+
+def parse_put_record(line):
+    """ Returns the (segment dict, encoding) of a put record
+    """
+    record = line[1:]
+    encoding = HEX_ENCODING
+    if not record.startswith('{'):
+        (encoding, _, record) = record.partition(' ')
+    return (json.loads(record), encoding)
+
+class PersistentSegmentStorage(ConcurrentSegmentStorage):
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, on_complete=None, sync_every=64, sync_interval=1.0, stripe_count=16):
+        ConcurrentSegmentStorage.__init__(self, max_bytes, ttl, on_complete, stripe_count)
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+        self.__log = None
+        self.__log_lock = threading.Lock()
+        ## number of put records of the payloads still stored
+        self.__counts = {}
+        self.__live = 0
+        self.__total = 0
+        self.compactions = 0
+        self.__completed = []
+        self.__load()
+
+    def __load(self):
+        """ Replay the segment log into memory. Only the records of payloads that
+        were never removed are turned into segments.
+        """
+        live = {}
+        total = 0
+        torn = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # torn write from a crash, everything before it is intact
+                        torn = True
+                        break
+                    total += 1
+                    if line[0] == PUT_RECORD:
+                        try:
+                            (data, encoding) = parse_put_record(line)
+                            payload_id = data["i"]
+                        except (ValueError, KeyError, TypeError):
+                            continue
+                        live.setdefault(payload_id, []).append((data, encoding))
+                    elif line[0] == REMOVE_RECORD:
+                        live.pop(line[1:-1], None)
+
+        self.__counts = dict([(payload_id, len(records)) for payload_id, records in live.items()])
+        self.__live = sum(self.__counts.values())
+        self.__total = total
+
+        self.__log = open(self.path, 'a')
+        on_complete = self.on_complete
+        self.on_complete = None
+        for payload_id, records in live.items():
+            completed = False
+            for (record, encoding) in records:
+                completed = SegmentStorage.put(self, TxTennaSegment.deserialize_from_dict(record, encoding)) or completed
+            if completed:
+                self.__completed.append(payload_id)
+        self.on_complete = on_complete
+
+        if torn or self.__total > 2 * self.__live:
+            with self.__log_lock:
+                self.__rewrite()
+
+    def replay_completed(self):
+        """ Pass the payloads that were complete in the log on startup to on_complete
+        """
+        completed = self.__completed
+        self.__completed = []
+        for payload_id in completed:
+            if self.on_complete is not None and self.is_complete(payload_id):
+                self.on_complete(payload_id, None)
+
+    def __compact(self):
+        """ Rewrite the log with a put record of every segment stored, atomically replacing the old one.
+        """
+        tmp_path = self.path + '.tmp'
+        counts = {}
+        with open(tmp_path, 'w') as f:
+            for payload_id, segments in self.stored_segments():
+                for segment in segments:
+                    f.write(put_record(segment))
+                counts[payload_id] = len(segments)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__counts = counts
+        self.__live = sum(counts.values())
+        self.__total = self.__live
+        self.compactions += 1
+
+    def __rewrite(self):
+        """ Compact the open log, the live records are written and synced to a new log that replaces it
+        """
+        self.__log.close()
+        self.__compact()
+        self.__log = open(self.path, 'a')
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+
+    def __append(self, record, payload_id):
+        with self.__log_lock:
+            if self.__log is None:
+                return
+            self.__log.write(record)
+            self.__log.flush()
+            self.__total += 1
+            if record[0] == PUT_RECORD:
+                self.__counts[payload_id] = self.__counts.get(payload_id, 0) + 1
+                self.__live += 1
+            else:
+                self.__live -= self.__counts.pop(payload_id, 0)
+
+            if self.__total >= COMPACT_MIN_RECORDS and self.__total > 2 * self.__live:
+                self.__rewrite()
+                return
+            self.__unsynced += 1
+            if self.__unsynced >= self.sync_every or time.monotonic() - self.__last_sync >= self.sync_interval:
+                self.__sync()
+
+    def __sync(self):
+        if self.__log is not None and self.__unsynced > 0:
+            self.__log.flush()
+            os.fsync(self.__log.fileno())
+        self.__unsynced = 0
+        self.__last_sync = time.monotonic()
+
+    def sync(self):
+        """ fsync all records written so far
+        """
+        with self.__log_lock:
+            self.__sync()
+
+    def close(self):
+        with self.__log_lock:
+            if self.__log is not None:
+                self.__sync()
+                self.__log.close()
+                self.__log = None
+
+    def put(self, segment, context=None):
+        ## a segment heard through two relays at once is only logged and counted once
+        with self.stripe(segment.payload_id):
+            if self.is_duplicate(segment):
+                return False
+            ## stored before it is logged, so a compaction in between does not lose it
+            completed = SegmentStorage.store(self, segment, context)
+            self.__append(put_record(segment), segment.payload_id)
+            if completed and self.on_complete is not None:
+                self.on_complete(segment.payload_id, context)
+        ## eviction takes the locks of other payloads, see ConcurrentSegmentStorage
+        self.evict()
+        return completed
+
+    def remove(self, payload_id):
+        with self.stripe(payload_id):
+            removed = SegmentStorage.remove(self, payload_id)
+            if removed:
+                self.__append(REMOVE_RECORD + payload_id + '\n', payload_id)
+            return removed
@@ -0,0 +1,109 @@
+'''
+Write received messages to the named pipe read by the blocksat API, from one
+worker thread that keeps the pipe open.
+
+Messages are queued by any thread and written in order, each with os.writev
+until all of its buffers are written, so the header and data of a message are
+never copied together or interleaved with another message. When the reader of
+the pipe goes away the pipe is opened again once a new reader shows up, and the
+message that was being written is written again from the start.
+'''
+
+import os
+import time
+import errno
+import queue
+import threading
+import traceback
+
+# seconds between attempts to open the pipe while it has no reader
+DEFAULT_REOPEN_INTERVAL = 1.0
+
+def writev_all(fd, buffers):
+    """ Write all of buffers to fd, continuing after short writes
+    """
+    views = [memoryview(b) for b in buffers if len(b) > 0]
+    while views:
+        written = os.writev(fd, views)
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written > 0:
+            views[0] = views[0][written:]
+
+class PipeSink:
+    def __init__(self, path, reopen_interval=DEFAULT_REOPEN_INTERVAL):
+        self.path = path
+        self.reopen_interval = reopen_interval
+        self.__queue = queue.Queue()
+        self.__fd = None
+        self.__thread = None
+        self.written = 0
+        self.reopened = 0
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.run, daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+        self.__close()
+
+    def write(self, *buffers):
+        """ Queue buffers to be written to the pipe as one message
+        """
+        self.__queue.put(buffers)
+
+    def depth(self):
+        return self.__queue.qsize()
+
+    def stats(self):
+        return {
+            "queued": self.__queue.qsize(),
+            "written": self.written,
+            "reopened": self.reopened
+        }
+
+    def __open(self):
+        """ Open the pipe for writing, waiting for a reader without blocking in open
+        """
+        while self.__fd is None:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+            except OSError as e:
+                ## ENXIO: a pipe without a reader, ENOENT: not created yet
+                if e.errno not in (errno.ENXIO, errno.ENOENT):
+                    raise
+                time.sleep(self.reopen_interval)
+                continue
+            os.set_blocking(fd, True)
+            self.__fd = fd
+        return self.__fd
+
+    def __close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def run(self):
+        while True:
+            buffers = self.__queue.get()
+            if buffers is None:
+                return
+            while True:
+                try:
+                    writev_all(self.__open(), buffers)
+                    self.written += 1
+                    break
+                except BrokenPipeError:
+                    ## the reader went away, write the whole message again to the next one
+                    self.__close()
+                    self.reopened += 1
+                except OSError:
+                    traceback.print_exc()
+                    self.__close()
+                    break
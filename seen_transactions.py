@@ -0,0 +1,121 @@
+'''
+Remember the transactions this gateway already handled, so copies that arrive
+through other relays or are broadcast again are not uploaded, sent to bitcoind
+or tracked a second time.
+
+Recent transactions are kept in an LRU with the last confirmation reply sent
+for them, which is replayed to the GIDs of later copies. Confirmed transactions
+are also added to a Bloom filter that remembers them long after they left the
+LRU, with a small chance (error_rate) of taking a new transaction for a
+confirmed one.
+'''
+
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_BLOOM_CAPACITY = 100000
+DEFAULT_BLOOM_ERROR_RATE = 1e-6
+
+class BloomFilter:
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def __positions(self, key):
+        ## double hashing, two 64 bit halves of one digest
+        digest = hashlib.sha256(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+class SeenTransactions:
+    """ Thread safe index of handled transactions and of the payloads that were copies of them.
+
+    The Bloom filter is replaced by a new one once it holds capacity transactions, the
+    previous one is still checked so confirmed transactions are remembered for at least
+    capacity more confirmations.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, bloom_capacity=DEFAULT_BLOOM_CAPACITY, bloom_error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.max_entries = max_entries
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.__entries = OrderedDict()
+        self.__ignored_payloads = OrderedDict()
+        self.__confirmed = BloomFilter(bloom_capacity, bloom_error_rate)
+        self.__previous_confirmed = None
+        self.__lock = threading.Lock()
+        self.duplicates = 0
+
+    def add(self, tx_hash):
+        """ Record a transaction as handled, returns False if it already was
+        """
+        with self.__lock:
+            if self.__seen(tx_hash):
+                return False
+            self.__entries[tx_hash] = None
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            return True
+
+    def lookup(self, tx_hash):
+        """ Returns (seen, reply), the last reply is None if it is not known (any more)
+        """
+        with self.__lock:
+            if tx_hash in self.__entries:
+                self.__entries.move_to_end(tx_hash)
+                return (True, self.__entries[tx_hash])
+            return (self.__seen(tx_hash), None)
+
+    def set_reply(self, tx_hash, reply, confirmed=False):
+        with self.__lock:
+            if tx_hash in self.__entries:
+                self.__entries[tx_hash] = reply
+            if confirmed:
+                if self.__confirmed.count >= self.bloom_capacity:
+                    self.__previous_confirmed = self.__confirmed
+                    self.__confirmed = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+                self.__confirmed.add(tx_hash)
+
+    def forget(self, tx_hash):
+        """ Handle the transaction again next time, eg. after it was not confirmed in time
+        """
+        with self.__lock:
+            self.__entries.pop(tx_hash, None)
+
+    def ignore_payload(self, payload_id):
+        """ Record a payload as a copy of a handled transaction, so its other segments are dropped
+        """
+        with self.__lock:
+            self.duplicates += 1
+            self.__ignored_payloads[payload_id] = True
+            while len(self.__ignored_payloads) > self.max_entries:
+                self.__ignored_payloads.popitem(last=False)
+
+    def is_ignored(self, payload_id):
+        return payload_id in self.__ignored_payloads
+
+    def stats(self):
+        return {
+            "recent": len(self.__entries),
+            "confirmed": self.__confirmed.count + (self.__previous_confirmed.count if self.__previous_confirmed else 0),
+            "duplicates": self.duplicates
+        }
+
+    def __seen(self, tx_hash):
+        return tx_hash in self.__entries or tx_hash in self.__confirmed or \
+            (self.__previous_confirmed is not None and tx_hash in self.__previous_confirmed)
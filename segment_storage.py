@@ -1,73 +1,418 @@
-''' 
+'''
 This module derived from Rich D's PyMuleTools respository:
 
 https://github.com/kansas-city-bitcoin-developers/PyMuleTools
 '''
 
-from txtenna_segment import TxTennaSegment
+import time
+import threading
+from collections import OrderedDict
+from txtenna_segment import TxTennaSegment, MAX_SEGMENT_COUNT
+import erasure_code
+
+# default limits for payloads that never complete, eg. because a segment was lost on the radio
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_TTL = 60 * 60
+
+# seconds between scans for expired payloads
+EXPIRY_CHECK_INTERVAL = 1.0
+
+# completed payloads remembered after they were removed, so late copies of their segments are dropped
+DEFAULT_MAX_FINISHED = 1024
+
+class ReassemblyBuffer:
+    """ Segments of a single payload, placed directly by sequence number.
+
+    A slot per sequence number is preallocated once the head segment (the one
+    carrying segment_count) arrives. Segments heard before the head are parked
+    by sequence number and moved into their slots when it shows up. The head
+    segment metadata is captured when it is stored, and the number of filled
+    slots is counted so completion is known without scanning.
+
+    Payloads sent with parity segments also get a slot for each of those, and are
+    complete as soon as the head and any segment_count - 1 other segments arrived.
+    The missing data segments are then rebuilt from the parity segments. A lost
+    head is asked for again, it is the only segment with the transaction hash.
+    """
 
-class SegmentStorage:
     def __init__(self):
-        self.__payloads = {}
+        self.segment_count = None
+        self.parity_count = 0
+        self.payload_length = None
+        self.tx_hash = None
+        self.network = None
+        self.block = None
+        self.slots = None
+        self.early = {}
+        self.received = 0
+        self.received_mask = 0
+        self.size = 0
+        self.completed = False
+        self.recovered = []
+        self.touched = time.monotonic()
+        self.nacked = 0
+        self.context = None
+
+    def has(self, sequence_num):
+        return (self.received_mask >> sequence_num) & 1 == 1
+
+    def put(self, segment):
+        """ Store a segment that was not received before, returns True if it was the last one missing
+        """
+        sequence_num = segment.sequence_num
+        self.touched = time.monotonic()
+        if segment.tx_hash is not None:
+            self.tx_hash = segment.tx_hash
+            self.network = segment.network
+            self.block = segment.block
+        elif segment.is_parity and self.network is None:
+            self.network = segment.network
+
+        if self.slots is not None and segment.is_parity and self.parity_count == 0 and not self.completed:
+            ## the head does not tell if parity segments follow, make room for them once one shows up
+            self.parity_count = segment.parity_count
+            self.payload_length = segment.payload_length
+            self.slots += [None] * self.parity_count
+
+        if self.slots is None:
+            if segment.segment_count is None:
+                self.early[sequence_num] = segment
+                self.__add(sequence_num, segment)
+                return False
+            self.segment_count = segment.segment_count
+            self.parity_count = segment.parity_count
+            self.payload_length = segment.payload_length
+            self.slots = [None] * (self.segment_count + self.parity_count)
+            for early_num, early_segment in self.early.items():
+                if early_num < len(self.slots):
+                    self.slots[early_num] = early_segment
+                else:
+                    self.__discard(early_num, early_segment)
+            self.early = None
+
+        if sequence_num < len(self.slots):
+            self.slots[sequence_num] = segment
+            self.__add(sequence_num, segment)
+
+        if self.completed or not self.is_complete():
+            return False
+        if None in self.slots[:self.segment_count]:
+            self.__recover()
+        self.completed = True
+        return True
+
+    def __recover(self):
+        """ Rebuild the missing tail segments from the data and parity segments received.
+        The parity segments are as long as the shards, the head and last segment were zero
+        padded to that length.
+        """
+        shards = dict([(n, bytes(s.data)) for n, s in enumerate(self.slots) if s is not None])
+        shard_len = max([len(shard) for shard in shards.values()])
+        shards = dict([(n, shard.ljust(shard_len, b'\0')) for n, shard in shards.items()])
+        data = erasure_code.decode(shards, self.segment_count, self.parity_count)
+        head = self.slots[0]
+        length = self.payload_length if self.payload_length is not None else len(head.data) + shard_len * (self.segment_count - 1)
+
+        for n in range(1, self.segment_count):
+            if self.slots[n] is not None:
+                continue
+            offset = len(head.data) + (n - 1) * shard_len
+            segment = TxTennaSegment(head.payload_id, data[n][:max(0, min(shard_len, length - offset))], sequence_num=n, encoding=head.encoding)
+            self.slots[n] = segment
+            self.__add(n, segment)
+            self.recovered.append(n)
+
+    def __add(self, sequence_num, segment):
+        self.received_mask |= 1 << sequence_num
+        self.received += 1
+        if segment.data is not None:
+            self.size += len(segment.data)
+
+    def __discard(self, sequence_num, segment):
+        self.received_mask &= ~(1 << sequence_num)
+        self.received -= 1
+        if segment.data is not None:
+            self.size -= len(segment.data)
+
+    def segments(self):
+        if self.slots is None:
+            return [self.early[n] for n in sorted(self.early)]
+        return [s for s in self.slots[:self.segment_count] if s is not None]
+
+    def stored(self):
+        """ The segments received, including parity segments and the ones parked before the head,
+        but not the ones rebuilt from parity segments
+        """
+        slots = self.slots
+        if slots is None:
+            early = self.early
+            if early is not None:
+                return list(early.values())
+            ## the head arrived in the meantime
+            slots = self.slots
+        return [s for n, s in enumerate(slots) if s is not None and n not in self.recovered]
+
+    def is_complete(self):
+        return self.segment_count is not None and self.received >= self.segment_count and self.has(0)
+
+    def missing(self):
+        """ Sequence numbers not received yet. Until the head segment arrives only the
+        gaps below the highest sequence number received so far are known.
+        """
+        if self.segment_count is not None:
+            count = self.segment_count
+        else:
+            count = max(self.early) + 1 if self.early else 1
+        return [n for n in range(count) if not (self.received_mask >> n) & 1]
+
+class SegmentStorage:
+    """ Reassemble segments into payloads.
+
+    Incomplete payloads are evicted once they have not been touched for ttl
+    seconds, or least recently touched first when the stored segment data
+    exceeds max_bytes. Pass None to disable either limit. Completed payloads
+    are never evicted, they should be removed once they have been processed.
+    The ids of the last max_finished payloads removed after they completed are
+    remembered, so segments relayed late do not start them over.
+
+    If given, on_complete(payload_id, context) is called as soon as the last
+    segment of a payload is put, with the context passed to that put.
+
+    The payload index is guarded by a lock, but segments of one payload must
+    be put from a single thread. Use ConcurrentSegmentStorage when several
+    threads ingest segments.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, on_complete=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_complete = on_complete
+        self.__payloads = OrderedDict()
         self.__transactionLookup = {}
+        self.__size = 0
+        self.__index_lock = threading.Lock()
+        self.__next_expiry_check = 0
+        self.__finished = OrderedDict()
+        self.max_finished = DEFAULT_MAX_FINISHED
+        self.evicted_expired = 0
+        self.evicted_lru = 0
+        self.duplicates_dropped = 0
 
     def get_raw_tx(self, segments):
-        raw_tx = ""
-        for segment in segments:
-            if segment.payload is not None:
-                raw_tx += segment.payload
-        return raw_tx
+        return b"".join([segment.data for segment in segments if segment.data is not None])
 
     def get(self, payload_id):
-        return self.__payloads[payload_id] if payload_id in self.__payloads else None
+        buffer = self.__payloads.get(payload_id)
+        return buffer.segments() if buffer is not None else None
+
+    def get_recovered(self, payload_id):
+        """ Segments of a completed payload that were rebuilt from parity segments rather than received
+        """
+        buffer = self.__payloads.get(payload_id)
+        return [buffer.slots[n] for n in buffer.recovered] if buffer is not None else None
 
     def get_by_transaction_id(self, tx_id):
-        if tx_id in self.__transactionLookup:
-            return self.__payloads[self.__transactionLookup[tx_id]]
+        payload_id = self.__transactionLookup.get(tx_id)
+        if payload_id is not None:
+            return self.get(payload_id)
         return None
 
     def get_transaction_id(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
-                    if segment.tx_hash is not None:
-                        return segment.tx_hash
-        return None
+        buffer = self.__payloads.get(payload_id)
+        return buffer.tx_hash if buffer is not None else None
 
     def get_network(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
-                    if segment.tx_hash is not None:
-                        if segment.testnet is True:
-                            return 't'
-                        elif segment.message is True:
-                            return 'd'
-                        else:
-                            return 'm'
+        buffer = self.__payloads.get(payload_id)
+        return buffer.network if buffer is not None else None
+
+    def get_block(self, payload_id):
+        """ Height of the block a merkle proof payload is for, None for other payloads
+        """
+        buffer = self.__payloads.get(payload_id)
+        return buffer.block if buffer is not None else None
 
     def remove(self, payload_id):
-        if payload_id in self.__payloads:
-            for segment in self.__payloads[payload_id]:
+        """ Remove a payload, returns False if it was not stored
+        """
+        with self.__index_lock:
+            buffer = self.__payloads.pop(payload_id, None)
+            if buffer is None:
+                return False
+            if buffer.tx_hash is not None and self.__transactionLookup.get(buffer.tx_hash) == payload_id:
+                del self.__transactionLookup[buffer.tx_hash]
+            self.__size -= buffer.size
+            if buffer.completed:
+                self.__finished[payload_id] = True
+                while len(self.__finished) > self.max_finished:
+                    self.__finished.popitem(last=False)
+            return True
+
+    def is_duplicate(self, segment):
+        """ Check if a segment was already stored, or its payload completed and was removed,
+        eg. because it was heard through several relays. Duplicates are counted as dropped.
+        """
+        buffer = self.__payloads.get(segment.payload_id)
+        if (buffer is not None and buffer.has(segment.sequence_num)) or \
+                (buffer is None and segment.payload_id in self.__finished):
+            with self.__index_lock:
+                self.duplicates_dropped += 1
+            return True
+        return False
+
+    def put(self, segment, context=None):
+        """ Put a segment, returns True only for the put that completed its payload.
+        Duplicate and out of range segments are dropped.
+        """
+        completed = self.store(segment, context)
+        self.evict()
+
+        if completed and self.on_complete is not None:
+            self.on_complete(segment.payload_id, context)
+        return completed
+
+    def store(self, segment, context=None):
+        """ Put a segment without evicting other payloads or calling on_complete, for
+        subclasses that hold a lock of the payload while it is stored
+        """
+        if not 0 <= segment.sequence_num < MAX_SEGMENT_COUNT or \
+                (segment.segment_count is not None and not 0 < segment.segment_count <= MAX_SEGMENT_COUNT):
+            return False
+        if self.is_duplicate(segment):
+            return False
+
+        with self.__index_lock:
+            buffer = self.__payloads.get(segment.payload_id)
+            if buffer is None:
+                buffer = self.__payloads[segment.payload_id] = ReassemblyBuffer()
+            else:
+                self.__payloads.move_to_end(segment.payload_id)
+
+        size = buffer.size
+        completed = buffer.put(segment)
+        if context is not None:
+            buffer.context = context
+
+        with self.__index_lock:
+            # the payload may have been evicted by another thread in the meantime
+            if self.__payloads.get(segment.payload_id) is buffer:
+                self.__size += buffer.size - size
                 if segment.tx_hash is not None:
-                    del self.__transactionLookup[segment.tx_hash]
-                    break
-            del self.__payloads[payload_id]
+                    self.__transactionLookup[segment.tx_hash] = segment.payload_id
+        return completed
 
-    def put(self, segment):
-        if segment.payload_id in self.__payloads:
-            payload = self.__payloads[segment.payload_id]
-            payload.append(segment)
-            if segment.sequence_num+1 != len(payload):
-                self.__payloads[segment.payload_id].sort(key=lambda p: p.sequence_num)
-        else:
-            self.__payloads[segment.payload_id] = [segment]
+    def stored_segments(self):
+        """ Yields the (payload_id, received segments) of every stored payload, see ReassemblyBuffer.stored
+        """
+        with self.__index_lock:
+            buffers = list(self.__payloads.items())
+        for payload_id, buffer in buffers:
+            yield (payload_id, buffer.stored())
 
-        if segment.tx_hash is not None:
-            self.__transactionLookup[segment.tx_hash] = segment.payload_id
+    def get_missing(self, payload_id):
+        buffer = self.__payloads.get(payload_id)
+        return buffer.missing() if buffer is not None else None
+
+    def stalled(self, quiet_period):
+        """ Find incomplete payloads that received no segment for quiet_period seconds.
+
+        Returns (payload_id, missing sequence numbers, context) tuples, where context is
+        the one given with the latest put. A payload is only returned again after another
+        quiet period passed without it receiving a segment.
+        """
+        now = time.monotonic()
+        stalled = []
+        with self.__index_lock:
+            for payload_id, buffer in self.__payloads.items():
+                if not buffer.completed and now - max(buffer.touched, buffer.nacked) >= quiet_period:
+                    buffer.nacked = now
+                    stalled.append((payload_id, buffer.context))
+        stalled = [(payload_id, self.get_missing(payload_id), context) for payload_id, context in stalled]
+        return [payload for payload in stalled if payload[1] is not None]
+
+    def evict(self):
+        """ Evict incomplete payloads that expired or no longer fit in the memory budget.
+        Payloads are kept in least recently touched order, so only the oldest need to be checked.
+        """
+        now = time.monotonic()
+        if (self.ttl is None or now < self.__next_expiry_check) and \
+                (self.max_bytes is None or self.__size <= self.max_bytes):
+            return
+
+        stale = []
+        victims = []
+        with self.__index_lock:
+            if self.ttl is not None and now >= self.__next_expiry_check:
+                self.__next_expiry_check = now + EXPIRY_CHECK_INTERVAL
+                expired = now - self.ttl
+                for payload_id, buffer in self.__payloads.items():
+                    if buffer.touched >= expired:
+                        break
+                    if not buffer.is_complete():
+                        stale.append(payload_id)
+
+            if self.max_bytes is not None and self.__size > self.max_bytes:
+                excess = self.__size - self.max_bytes
+                for payload_id, buffer in self.__payloads.items():
+                    if excess <= 0:
+                        break
+                    if not buffer.is_complete() and payload_id not in stale:
+                        victims.append(payload_id)
+                        excess -= buffer.size
+
+        expired_count = len([payload_id for payload_id in stale if self.remove(payload_id)])
+        lru_count = len([payload_id for payload_id in victims if self.remove(payload_id)])
+        if expired_count or lru_count:
+            with self.__index_lock:
+                self.evicted_expired += expired_count
+                self.evicted_lru += lru_count
+
+    def stats(self):
+        return {
+            "payloads": len(self.__payloads),
+            "bytes": self.__size,
+            "evicted_expired": self.evicted_expired,
+            "evicted_lru": self.evicted_lru,
+            "duplicates_dropped": self.duplicates_dropped
+        }
 
     def is_complete(self, payload_id):
-        segments = self.get(payload_id)
-        if segments is not None:
-            segment = next((s for s in segments if s.segment_count is not None), None)
-            return segment is not None and segment.segment_count == len(segments)
+        buffer = self.__payloads.get(payload_id)
+        return buffer is not None and buffer.is_complete()
 
-        return False
+class ConcurrentSegmentStorage(SegmentStorage):
+    """ SegmentStorage that can be shared by several ingesting threads.
+
+    Operations on a payload hold one of stripe_count locks picked by the hash
+    of its payload_id, so segments of unrelated payloads never contend. Other
+    payloads are only evicted once that lock is released, so a thread never
+    holds more than one of them.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, on_complete=None, stripe_count=16):
+        SegmentStorage.__init__(self, max_bytes, ttl, on_complete)
+        self.__stripes = [threading.RLock() for _ in range(stripe_count)]
+
+    def stripe(self, payload_id):
+        """ The lock held by operations on payload_id, reentrant so subclasses can hold it across several
+        """
+        return self.__stripes[hash(payload_id) % len(self.__stripes)]
+
+    def get(self, payload_id):
+        with self.stripe(payload_id):
+            return SegmentStorage.get(self, payload_id)
+
+    def get_recovered(self, payload_id):
+        with self.stripe(payload_id):
+            return SegmentStorage.get_recovered(self, payload_id)
+
+    def get_missing(self, payload_id):
+        with self.stripe(payload_id):
+            return SegmentStorage.get_missing(self, payload_id)
+
+    def put(self, segment, context=None):
+        with self.stripe(segment.payload_id):
+            completed = SegmentStorage.store(self, segment, context)
+            if completed and self.on_complete is not None:
+                self.on_complete(segment.payload_id, context)
+        self.evict()
+        return completed
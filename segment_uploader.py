@@ -0,0 +1,121 @@
+'''
+Upload received segments to txtenna-server in the background, so the goTenna
+event thread only has to queue them.
+'''
+
+import time
+import queue
+import threading
+import traceback
+import requests
+from requests.adapters import HTTPAdapter
+
+# default txtenna-server segments endpoint
+TXTENNA_SEGMENTS_URL = "https://api.samouraiwallet.com/v2/txtenna/segments"
+
+class SegmentUploader:
+    """ Queue of segment JSON to POST to txtenna-server from a worker thread.
+
+    The worker keeps its connections open in a requests.Session and drains up to
+    batch_size queued segments at a time, sending them back to back over the same
+    connection. Failed uploads (connection errors and 5xx responses) are retried up
+    to max_retries times, waiting backoff, 2 * backoff, ... seconds in between.
+
+    The queue holds at most max_queued segments, further ones are dropped and counted
+    rather than blocking the caller.
+    """
+
+    def __init__(self, url=TXTENNA_SEGMENTS_URL, max_queued=1000, batch_size=16, max_retries=3, backoff=1.0, timeout=30):
+        self.url = url
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.__queue = queue.Queue(max_queued)
+        self.__thread = None
+        self.__session = None
+        self.enqueued = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.run, daemon=True)
+            self.__thread.start()
+
+    def enqueue(self, segment_json):
+        """ Queue a segment for upload, returns False if it was dropped because the queue is full
+        """
+        try:
+            self.__queue.put_nowait(segment_json)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.__queue.qsize())
+        return True
+
+    def depth(self):
+        return self.__queue.qsize()
+
+    def stats(self):
+        return {
+            "queued": self.__queue.qsize(),
+            "max_queued": self.max_depth,
+            "enqueued": self.enqueued,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "batches": self.batches
+        }
+
+    def __connect(self):
+        if self.__session is None:
+            self.__session = requests.Session()
+            self.__session.headers.update({u'content-type': u'application/json'})
+            self.__session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.batch_size))
+            self.__session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.batch_size))
+        return self.__session
+
+    def run(self):
+        while True:
+            batch = [self.__queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.batches += 1
+            for segment_json in batch:
+                self.upload(segment_json)
+
+    def upload(self, segment_json):
+        """ POST one segment, retrying failures with exponential backoff. Returns True once it was accepted.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.retries += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.__connect().post(self.url, data=segment_json, timeout=self.timeout)
+            except requests.RequestException:
+                ## start over with fresh connections
+                self.__session.close()
+                self.__session = None
+                continue
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                break
+            print(r.text)
+            if r.status_code < 500:
+                if r.status_code < 400:
+                    self.uploaded += 1
+                    return True
+                break
+        self.failed += 1
+        return False
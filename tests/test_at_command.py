@@ -0,0 +1,110 @@
+import os
+import pty
+import termios
+import threading
+
+import pytest
+import serial
+
+from at_command import ATCommandEngine, final_result, is_error
+
+class FakeModem:
+    """ Answers AT commands written to the other end of a pty with canned responses
+    """
+
+    def __init__(self, master, slave, responses):
+        self.master = master
+        self.slave = slave
+        self.responses = responses
+        self.commands = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pending = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            pending += data
+            ## commands end with a carriage return, the text of an SMS with ctrl-z
+            while b'\r' in pending or b'\x1a' in pending:
+                end = min([pending.index(c) for c in (b'\r', b'\x1a') if c in pending]) + 1
+                (command, pending) = (pending[:end], pending[end:])
+                self.commands.append(command)
+                response = self.responses.get(command)
+                if response is not None:
+                    os.write(self.master, response)
+
+    def stop(self):
+        """ Once the last slave fd is closed the read fails with EIO, and the thread ends
+        before the master fd is closed and can be reused by another pty
+        """
+        os.close(self.slave)
+        self.thread.join()
+        os.close(self.master)
+
+@pytest.fixture
+def modem():
+    (master, slave) = pty.openpty()
+    port = serial.Serial(os.ttyname(slave), 115200)
+    ## echo would hand the command back to the engine as part of the response
+    attrs = termios.tcgetattr(slave)
+    attrs[3] &= ~termios.ECHO
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    modems = []
+    def start(responses):
+        modems.append(FakeModem(master, slave, responses))
+        return modems[-1]
+    yield (port, start)
+    port.close()
+    if modems:
+        modems[0].stop()
+    else:
+        os.close(slave)
+        os.close(master)
+
+def test_command_returns_at_ok(modem):
+    (port, start) = modem
+    start({b'AT+CMGF=1\r': b'\r\nOK\r\n'})
+    engine = ATCommandEngine(port, 2)
+    response = engine.command(b'AT+CMGF=1\r')
+    assert final_result(response) == b'OK'
+    assert not is_error(response)
+
+def test_command_returns_at_cms_error(modem):
+    (port, start) = modem
+    start({b'AT+CMGR=1\r': b'\r\n+CMS ERROR: 321\r\n'})
+    response = ATCommandEngine(port, 2).command(b'AT+CMGR=1\r')
+    assert final_result(response) == b'+CMS ERROR: 321'
+    assert is_error(response)
+
+def test_command_waits_for_the_result_after_data_lines(modem):
+    (port, start) = modem
+    start({b'AT+CMGL="REC UNREAD"\r': b'\r\n+CMGL: 1,"REC UNREAD","+15551234567"\r\nhello\r\n\r\nOK\r\n'})
+    response = ATCommandEngine(port, 2).command(b'AT+CMGL="REC UNREAD"\r')
+    assert b'hello' in response
+    assert final_result(response) == b'OK'
+
+def test_sms_prompt_then_send(modem):
+    (port, start) = modem
+    fake = start({b'AT+CMGS="+15551234567"\r': b'\r\n> ', b'hello\x1a': b'\r\n+CMGS: 7\r\n\r\nOK\r\n'})
+    engine = ATCommandEngine(port, 2)
+    prompt = engine.command(b'AT+CMGS="+15551234567"\r', expect_prompt=True)
+    assert prompt.endswith(b'> ')
+    assert final_result(prompt) is None
+    response = engine.command(b'hello\x1a', timeout=5)
+    assert b'+CMGS: 7' in response and final_result(response) == b'OK'
+    assert fake.commands == [b'AT+CMGS="+15551234567"\r', b'hello\x1a']
+
+def test_command_times_out_without_final_result(modem):
+    (port, start) = modem
+    start({b'AT+CMGD=1\r': b'\r\n+CMGD: partial'})
+    engine = ATCommandEngine(port, 0.3)
+    with pytest.raises(serial.SerialTimeoutException):
+        engine.command(b'AT+CMGD=1\r')
+    assert engine.timeouts == 1
+    assert engine.commands == 1
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+import zmq
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint, b2lx, lx
+
+from bitcoin_zmq import BitcoinZMQListener
+
+class RecordingScheduler:
+    """ Records what the listener tells a ConfirmationScheduler
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.polls = 0
+
+    def update(self, tx_hash, block):
+        self.updates.append((tx_hash, block))
+
+    def poll_now(self):
+        self.polls += 1
+
+@pytest.fixture
+def publisher():
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    port = socket.bind_to_random_port('tcp://127.0.0.1')
+    scheduler = RecordingScheduler()
+    listener = BitcoinZMQListener(scheduler, ['tcp://127.0.0.1:' + str(port)], context)
+    listener.start()
+    yield (socket, scheduler, listener)
+    listener.stop()
+    socket.close(linger=0)
+    context.term()
+
+def publish_until(socket, parts, done, timeout=5.0):
+    """ Publish parts until done() holds, a subscriber misses what is published before it connected
+    """
+    deadline = time.monotonic() + timeout
+    while not done():
+        assert time.monotonic() < deadline, "notification was not handled"
+        socket.send_multipart(parts)
+        time.sleep(0.05)
+
+def test_rawtx_reports_the_transaction_in_the_mempool(publisher):
+    (socket, scheduler, listener) = publisher
+    tx = CMutableTransaction([CMutableTxIn(COutPoint(lx('cd' * 32), 0))], [CMutableTxOut(1000, b'\x51')])
+    publish_until(socket, [b'rawtx', tx.serialize(), b'\0\0\0\0'], lambda: scheduler.updates)
+    assert scheduler.updates[0] == (b2lx(tx.GetTxid()), 0)
+    assert scheduler.polls == 0
+
+def test_hashblock_polls_now(publisher):
+    (socket, scheduler, listener) = publisher
+    publish_until(socket, [b'hashblock', bytes(32), b'\0\0\0\0'], lambda: scheduler.polls)
+    assert scheduler.updates == []
+
+def test_sequence_notifications(publisher):
+    (socket, scheduler, listener) = publisher
+    tx_hash = 'ab' * 31 + '01'
+    publish_until(socket, [b'sequence', bytes.fromhex(tx_hash) + b'A' + (7).to_bytes(8, 'little'), b'\0\0\0\0'], lambda: scheduler.updates)
+    assert scheduler.updates[0] == (tx_hash, 0)
+
+    publish_until(socket, [b'sequence', bytes(32) + b'C', b'\0\0\0\0'], lambda: scheduler.polls)
+    ## transactions removed from the mempool are not news to the scheduler
+    before = listener.notifications
+    publish_until(socket, [b'sequence', bytes(32) + b'R' + (8).to_bytes(8, 'little'), b'\0\0\0\0'], lambda: listener.notifications > before)
+    assert all(update == (tx_hash, 0) for update in scheduler.updates)
@@ -0,0 +1,34 @@
+import itertools
+import os
+
+import pytest
+
+import erasure_code
+
+@pytest.mark.parametrize("data_count, parity_count", [(1, 1), (2, 1), (3, 2), (5, 3), (8, 4)])
+def test_decode_every_erasure_pattern(data_count, parity_count):
+    data = [os.urandom(24) for _ in range(data_count)]
+    parity = erasure_code.encode(data, parity_count)
+    assert len(parity) == parity_count
+    assert all(len(shard) == 24 for shard in parity)
+    shards = dict(enumerate(data + parity))
+
+    for lost_count in range(parity_count + 1):
+        for lost in itertools.combinations(range(data_count + parity_count), lost_count):
+            received = dict([(n, shard) for n, shard in shards.items() if n not in lost])
+            assert erasure_code.decode(received, data_count, parity_count) == data, lost
+
+def test_decode_needs_data_count_shards():
+    data = [os.urandom(8) for _ in range(4)]
+    parity = erasure_code.encode(data, 2)
+    shards = dict(enumerate(data + parity))
+    for lost in itertools.combinations(range(6), 3):
+        with pytest.raises(ValueError):
+            erasure_code.decode(dict([(n, s) for n, s in shards.items() if n not in lost]), 4, 2)
+
+def test_parity_of_zero_shards_is_zero():
+    assert erasure_code.encode([bytes(16)] * 3, 2) == [bytes(16)] * 2
+
+def test_too_many_shards():
+    with pytest.raises(ValueError):
+        erasure_code.encode([bytes(1)] * 200, 57)
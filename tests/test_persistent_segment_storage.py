@@ -0,0 +1,70 @@
+import os
+import threading
+
+import pytest
+
+from persistent_segment_storage import PersistentSegmentStorage
+from txtenna_segment import TxTennaSegment
+
+def payload_segments(n, length=600):
+    raw = os.urandom(length)
+    return (raw, list(TxTennaSegment.tx_to_cbor_segments(str(n), raw, '%064x' % n, str(n))))
+
+def test_concurrent_put_with_eviction_does_not_deadlock(tmp_path):
+    storage = PersistentSegmentStorage(str(tmp_path / 'segments.log'), max_bytes=2000)
+    ## incomplete payloads, so the memory budget keeps evicting the payloads of other threads
+    work = [[segment for n in range(t, 400, 4) for segment in payload_segments(n)[1][1:]] for t in range(4)]
+    threads = [threading.Thread(target=lambda segments: [storage.put(s) for s in segments], args=(segments,), daemon=True) for segments in work]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not any(thread.is_alive() for thread in threads)
+    assert storage.evicted_lru > 0
+    assert storage.stats()["bytes"] <= 2000
+    storage.close()
+
+def test_log_is_compacted_while_running_and_reloads(tmp_path):
+    path = str(tmp_path / 'segments.log')
+    storage = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    ## a payload still missing its head, and one that completed with a parity segment
+    (early_raw, early) = payload_segments(100000)
+    raw = os.urandom(1000)
+    plan = TxTennaSegment.plan(len(raw), 'parity', 'cd' * 32, '1', parity_ratio=0.5)
+    parity = list(TxTennaSegment.segments_for_plan(plan, raw))
+    for segment in early[1:] + parity[:2] + parity[3:plan.segment_count] + parity[-1:]:
+        storage.put(segment)
+    for n in range(1000):
+        for segment in payload_segments(n, 300)[1]:
+            storage.put(segment)
+        storage.remove(segment.payload_id)
+    storage.close()
+
+    assert storage.compactions > 0
+    assert sum(1 for _ in open(path)) < 1000
+    reloaded = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    assert reloaded.stats()["payloads"] == 2
+    assert reloaded.get_missing(early[0].payload_id) == [0]
+    ## the segment rebuilt from parity is not logged, it is rebuilt again
+    assert reloaded.is_complete(plan.payload_id)
+    assert [segment.sequence_num for segment in reloaded.get_recovered(plan.payload_id)] == [2]
+    assert reloaded.get_raw_tx(reloaded.get(plan.payload_id)) == raw
+
+    reloaded.put(early[0])
+    assert reloaded.get_raw_tx(reloaded.get(early[0].payload_id)) == early_raw
+    reloaded.close()
+
+@pytest.mark.parametrize("network, isZ85", [('m', True), ('d', False)])
+def test_log_keeps_the_encoding_of_segments(tmp_path, network, isZ85):
+    path = str(tmp_path / 'segments.log')
+    raw = b'ab12' * 100 if network == 'd' else os.urandom(400)
+    segments = list(TxTennaSegment.tx_to_segments('1', raw, 'ab' * 32, '1', network, isZ85))
+    storage = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    for segment in segments[1:]:
+        storage.put(segment)
+    storage.close()
+
+    reloaded = PersistentSegmentStorage(path, max_bytes=None, ttl=None)
+    reloaded.put(segments[0])
+    assert reloaded.get_raw_tx(reloaded.get(segments[0].payload_id)) == raw
+    reloaded.close()
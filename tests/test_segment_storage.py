@@ -0,0 +1,141 @@
+import os
+import random
+import time
+
+import segment_storage
+from segment_storage import SegmentStorage, ConcurrentSegmentStorage
+from txtenna_segment import TxTennaSegment, MAX_SEGMENT_COUNT
+
+def payload_segments(messageIdx, length=600):
+    raw = os.urandom(length)
+    return (raw, list(TxTennaSegment.tx_to_cbor_segments('1', raw, 'ab' * 32, str(messageIdx))))
+
+def test_duplicate_segments_are_dropped():
+    (raw, segments) = payload_segments(1)
+    storage = SegmentStorage()
+    assert storage.put(segments[1]) is False
+    assert storage.put(segments[1]) is False
+    assert storage.is_duplicate(segments[1])
+    assert storage.stats()["duplicates_dropped"] == 2
+    assert storage.get_missing(segments[0].payload_id) == [0]
+
+def test_late_copies_of_a_removed_payload_are_dropped():
+    (raw, segments) = payload_segments(2)
+    completed = []
+    storage = ConcurrentSegmentStorage()
+    storage.on_complete = lambda payload_id, context: completed.append(storage.get_raw_tx(storage.get(payload_id))) or storage.remove(payload_id)
+    for segment in segments:
+        storage.put(segment, 7)
+    assert completed == [raw]
+
+    ## a relay repeating a segment does not start the payload over, or get it asked for again
+    assert storage.put(segments[2], 8) is False
+    assert storage.get_missing(segments[0].payload_id) is None
+    assert storage.stalled(0) == []
+    assert storage.stats()["duplicates_dropped"] == 1
+
+def test_removed_payloads_are_remembered_up_to_max_finished():
+    storage = SegmentStorage()
+    storage.max_finished = 2
+    payloads = [payload_segments(n)[1] for n in range(3)]
+    for segments in payloads:
+        for segment in segments:
+            storage.put(segment)
+        storage.remove(segments[0].payload_id)
+    assert not storage.is_duplicate(payloads[0][1])
+    assert storage.is_duplicate(payloads[1][1])
+    assert storage.is_duplicate(payloads[2][1])
+
+def test_payloads_removed_incomplete_are_not_remembered():
+    (raw, segments) = payload_segments(3)
+    storage = SegmentStorage(max_bytes=None, ttl=None)
+    storage.put(segments[1])
+    storage.remove(segments[0].payload_id)
+    assert storage.put(segments[1]) is False
+    assert storage.get_missing(segments[0].payload_id) == [0]
+
+def test_segments_in_any_order_fill_their_slots():
+    (raw, segments) = payload_segments(10, 2000)
+    arrival = list(segments)
+    random.Random(1).shuffle(arrival)
+    completed = []
+    storage = SegmentStorage(on_complete=lambda payload_id, context: completed.append(context))
+    for n, segment in enumerate(arrival):
+        assert storage.put(segment, n) == (n == len(arrival) - 1)
+    assert completed == [len(arrival) - 1]
+    assert storage.get_raw_tx(storage.get(segments[0].payload_id)) == raw
+    assert storage.get_transaction_id(segments[0].payload_id) == 'ab' * 32
+
+def test_segments_before_the_head_are_parked():
+    (raw, segments) = payload_segments(11)
+    payload_id = segments[0].payload_id
+    storage = SegmentStorage()
+    storage.put(segments[3])
+    storage.put(segments[1])
+    ## only the gaps below the highest sequence number are known before the head
+    assert storage.get_missing(payload_id) == [0, 2]
+    assert [segment.sequence_num for segment in storage.get(payload_id)] == [1, 3]
+    storage.put(segments[0])
+    assert storage.get_missing(payload_id) == [2] + list(range(4, len(segments)))
+
+def test_parked_segments_beyond_the_segment_count_are_dropped():
+    (raw, segments) = payload_segments(12)
+    stray = TxTennaSegment(segments[0].payload_id, b'stray', sequence_num=len(segments) + 3)
+    storage = SegmentStorage()
+    storage.put(stray)
+    for segment in segments:
+        storage.put(segment)
+    assert storage.is_complete(segments[0].payload_id)
+    assert storage.get_raw_tx(storage.get(segments[0].payload_id)) == raw
+
+def test_out_of_range_segments_are_dropped():
+    storage = SegmentStorage()
+    assert storage.put(TxTennaSegment('00', b'x', sequence_num=MAX_SEGMENT_COUNT)) is False
+    assert storage.put(TxTennaSegment('00', b'x', tx_hash='ab' * 32, segment_count=0)) is False
+    assert storage.stats()["payloads"] == 0
+
+def test_expired_payloads_are_evicted(monkeypatch):
+    monkeypatch.setattr(segment_storage, 'EXPIRY_CHECK_INTERVAL', 0)
+    (_, stale) = payload_segments(13)
+    (_, fresh) = payload_segments(14)
+    (_, complete) = payload_segments(15)
+    storage = SegmentStorage(max_bytes=None, ttl=0.05)
+    storage.put(stale[1])
+    for segment in complete:
+        storage.put(segment)
+    time.sleep(0.1)
+    storage.put(fresh[1])
+    assert storage.get(stale[0].payload_id) is None
+    assert storage.get(fresh[0].payload_id) is not None
+    ## completed payloads wait for their owner to remove them
+    assert storage.is_complete(complete[0].payload_id)
+    assert storage.stats()["evicted_expired"] == 1
+
+def test_least_recently_touched_payloads_are_evicted_over_the_budget():
+    payloads = [payload_segments(n)[1] for n in range(20, 24)]
+    storage = SegmentStorage(max_bytes=1000, ttl=None)
+    for segments in payloads[:3]:
+        storage.put(segments[1])
+        storage.put(segments[2])
+    ## touching the oldest payload makes the second one the least recently touched
+    storage.put(payloads[0][3])
+    storage.put(payloads[3][1])
+    storage.put(payloads[3][2])
+    assert storage.get(payloads[1][0].payload_id) is None
+    assert storage.get(payloads[0][0].payload_id) is not None
+    assert storage.stats()["bytes"] <= 1000
+    assert storage.stats()["evicted_lru"] >= 1
+
+def test_parity_segments_extend_the_slots_after_the_head():
+    raw = os.urandom(1000)
+    plan = TxTennaSegment.plan(len(raw), '1', 'ab' * 32, '1', parity_ratio=0.5)
+    segments = list(TxTennaSegment.segments_for_plan(plan, raw))
+    storage = SegmentStorage()
+    storage.put(segments[0])
+    assert storage.get_missing(plan.payload_id) == list(range(1, plan.segment_count))
+    ## the last data segment is lost, a parity segment stands in for it
+    for segment in segments[1:plan.segment_count - 1] + segments[-1:]:
+        storage.put(segment)
+    assert storage.is_complete(plan.payload_id)
+    assert [segment.sequence_num for segment in storage.get_recovered(plan.payload_id)] == [plan.segment_count - 1]
+    assert storage.get_raw_tx(storage.get(plan.payload_id)) == raw
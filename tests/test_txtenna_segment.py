@@ -0,0 +1,97 @@
+import itertools
+import os
+import random
+import zlib
+
+import cbor
+import pytest
+
+from segment_storage import SegmentStorage
+from txtenna_segment import TxTennaSegment, HEX_ENCODING, Z85_ENCODING, TEXT_ENCODING, MESH_PAYLOAD_SIZE
+
+@pytest.mark.parametrize("encoding, network, isZ85", [(HEX_ENCODING, 'm', False), (Z85_ENCODING, 't', True), (TEXT_ENCODING, 'd', False)])
+def test_json_round_trip_keeps_the_data(encoding, network, isZ85):
+    ## text that is also valid hex must not be decoded as hex
+    raw = b'ab12' * 100 if encoding == TEXT_ENCODING else os.urandom(400)
+    segments = list(TxTennaSegment.tx_to_segments('1', raw, 'ab' * 32, '1', network, isZ85))
+    assert all(segment.encoding == encoding for segment in segments)
+    received = [TxTennaSegment.deserialize_from_json(segment.serialize_to_json(), encoding) for segment in segments]
+    assert b''.join([bytes(segment.data) for segment in received]) == raw
+    assert [segment.payload for segment in received] == [segment.payload for segment in segments]
+
+def reassemble(segments):
+    storage = SegmentStorage()
+    for segment in segments:
+        storage.put(TxTennaSegment.deserialize_from_cbor(cbor.loads(segment.serialize_to_cbor())))
+    payload_id = segments[0].payload_id
+    if not storage.is_complete(payload_id):
+        return None
+    return storage.get_raw_tx(storage.get(payload_id))
+
+def chunked(raw, size):
+    return [raw[offset:offset + size] for offset in range(0, len(raw), size)]
+
+@pytest.mark.parametrize("length", [1, 95, 96, 300, 1000])
+@pytest.mark.parametrize("parity_ratio", [0.0, 0.25, 0.5, 1.0])
+def test_segments_fit_the_mesh_payload(length, parity_ratio):
+    raw = os.urandom(length)
+    plan = TxTennaSegment.plan(length, '1', 'ab' * 32, '1', parity_ratio=parity_ratio)
+    segments = list(TxTennaSegment.segments_for_plan(plan, raw))
+    assert len(segments) == plan.segment_count + plan.parity_count
+    assert all(len(segment.serialize_to_cbor()) <= MESH_PAYLOAD_SIZE for segment in segments)
+    assert sum([len(segment.serialize_to_cbor()) for segment in segments]) <= plan.air_bytes
+    ## the data segments are the same as without parity, only the tails may be capped to fit a parity segment
+    assert all(not segment.is_parity for segment in segments[:plan.segment_count])
+    assert all(segment.is_parity and segment.tx_hash is None for segment in segments[plan.segment_count:])
+
+@pytest.mark.parametrize("length", [1, 300, 1000])
+@pytest.mark.parametrize("parity_ratio", [0.25, 0.5])
+def test_any_losses_up_to_the_parity_count_are_recovered(length, parity_ratio):
+    raw = os.urandom(length)
+    plan = TxTennaSegment.plan(length, '1', 'ab' * 32, '1', parity_ratio=parity_ratio)
+    segments = list(TxTennaSegment.segments_for_plan(plan, raw))
+    assert plan.parity_count > 0
+
+    ## the head carries the transaction hash, a lost head is asked for again
+    for lost_count in range(plan.parity_count + 1):
+        for lost in itertools.combinations(range(1, len(segments)), lost_count):
+            received = [segment for n, segment in enumerate(segments) if n not in lost]
+            assert reassemble(received) == raw, lost
+    assert reassemble(segments[1:]) is None
+
+def test_too_many_losses_leave_the_payload_incomplete():
+    raw = os.urandom(1000)
+    plan = TxTennaSegment.plan(len(raw), '1', 'ab' * 32, '1', parity_ratio=0.25)
+    segments = list(TxTennaSegment.segments_for_plan(plan, raw))
+    assert reassemble(segments[:1] + segments[plan.parity_count + 2:]) is None
+
+@pytest.mark.parametrize("order", ["parity first", "head last", "shuffled"])
+def test_streamed_payload_with_losses_in_any_arrival_order(order):
+    random.seed(order)
+    raw = zlib.compress(os.urandom(800) + b'hello' * 400)
+    ## sized for the longest the data could get, like a file compressed while it is sent
+    plan = TxTennaSegment.plan(len(raw) + 100, '1', 'message.txt', '1', 'd', parity_ratio=0.5)
+    segments = list(TxTennaSegment.stream_segments_for_plan(plan, chunked(raw, 37)))
+    head = [segment for segment in segments if segment.sequence_num == 0]
+    data = [segment for segment in segments if segment.sequence_num > 0 and not segment.is_parity]
+    parity = [segment for segment in segments if segment.is_parity]
+    assert len(head) == 1 and len(parity) > 1
+
+    lost = random.sample(data, len(parity))
+    data = [segment for segment in data if segment not in lost]
+    if order == "parity first":
+        arrival = parity + head + data
+    elif order == "head last":
+        arrival = data + parity + head
+    else:
+        arrival = head + data + parity
+        random.shuffle(arrival)
+    assert reassemble(arrival) == raw
+
+def test_streamed_payload_without_parity():
+    raw = os.urandom(500)
+    plan = TxTennaSegment.plan(len(raw), '1', 'message.txt', '1', 'd')
+    segments = list(TxTennaSegment.stream_segments_for_plan(plan, chunked(raw, 64)))
+    assert segments[-1].sequence_num == 0
+    assert reassemble(segments) == raw
+    assert reassemble(segments[1:]) is None
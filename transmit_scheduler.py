@@ -0,0 +1,129 @@
+'''
+Pace mesh transmissions by the airtime they take rather than a fixed delay.
+
+Every message is queued and sent from one worker thread, which takes the
+estimated airtime of each message from a token bucket. The bucket refills at
+the duty cycle allowed in the geo region (1 second of airtime per second where
+there is no limit) and holds at most burst seconds, so messages go out back to
+back as fast as the channel and the rules allow.
+'''
+
+import time
+import queue
+import threading
+import traceback
+from txtenna_segment import MESH_BITRATE, SEGMENT_OVERHEAD_SECONDS
+
+# seconds of airtime that may be sent in one go after the channel was idle
+DEFAULT_BURST_SECONDS = 10.0
+
+# estimated bits per second per Hz of bandwidth, for the configurable bandwidths of goTenna Pro
+BITS_PER_HZ = 0.5
+
+# largest share of time a transmitter may be on the air, by goTenna geo region. The
+# 869.4-869.65 MHz sub-band used in Europe allows 10%, other regions are not limited.
+REGION_DUTY_CYCLES = {2: 0.1}
+
+# queue priorities, control messages such as confirmations and missing segment requests
+# are not held up behind the segments of a large payload
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+
+def bitrate_for_bandwidth(bandwidth_khz):
+    if bandwidth_khz is None:
+        return MESH_BITRATE
+    return bandwidth_khz * 1000 * BITS_PER_HZ
+
+class TokenBucket:
+    """ Tokens refill at rate per second up to capacity. Taking more than there are leaves a
+    debt that has to refill before the next take succeeds.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount):
+        """ Take amount tokens, returns the seconds to wait until they are covered
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class TransmitScheduler:
+    def __init__(self, bandwidth_khz=None, geo_region=None, burst=DEFAULT_BURST_SECONDS):
+        self.burst = burst
+        self.__queue = queue.PriorityQueue()
+        self.__count = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.sent = 0
+        self.airtime = 0.0
+        self.waited = 0.0
+        self.configure(bandwidth_khz, geo_region)
+
+    def configure(self, bandwidth_khz=None, geo_region=None):
+        """ Size the pacing from the RF settings, eg. after set_bandwidth or set_geo_region
+        """
+        with self.__lock:
+            self.bitrate = bitrate_for_bandwidth(bandwidth_khz)
+            self.duty_cycle = REGION_DUTY_CYCLES.get(geo_region, 1.0)
+            self.__bucket = TokenBucket(self.duty_cycle, self.burst * self.duty_cycle)
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.run, daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__queue.put((PRIORITY_CONTROL - 1, 0, None, None))
+            self.__thread.join()
+            self.__thread = None
+
+    def message_airtime(self, size):
+        """ Estimated seconds on air for a message of size bytes
+        """
+        return SEGMENT_OVERHEAD_SECONDS + size * 8.0 / self.bitrate
+
+    def submit(self, send, data, priority=PRIORITY_BULK):
+        """ Queue send(data) and return straight away
+        """
+        with self.__lock:
+            self.__count += 1
+            self.__queue.put((priority, self.__count, send, data))
+
+    def pending(self):
+        return self.__queue.qsize()
+
+    def stats(self):
+        return {
+            "queued": self.__queue.qsize(),
+            "sent": self.sent,
+            "airtime": round(self.airtime, 1),
+            "waited": round(self.waited, 1),
+            "bitrate": self.bitrate,
+            "duty_cycle": self.duty_cycle
+        }
+
+    def run(self):
+        while True:
+            (priority, count, send, data) = self.__queue.get()
+            if send is None:
+                return
+            airtime = self.message_airtime(len(data))
+            with self.__lock:
+                wait = self.__bucket.take(airtime)
+            if wait > 0:
+                self.waited += wait
+                time.sleep(wait)
+            try:
+                send(data)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+            self.sent += 1
+            self.airtime += airtime
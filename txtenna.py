@@ -6,52 +6,151 @@ import traceback
 import logging
 import requests
 import json
-from threading import Thread
+from threading import Thread, Lock
 from time import sleep
 import random
 import string
 import binascii
-from segment_storage import SegmentStorage
-from txtenna_segment import TxTennaSegment
+import functools
+import base64
+from segment_storage import ConcurrentSegmentStorage
+from persistent_segment_storage import PersistentSegmentStorage
+from segment_uploader import SegmentUploader
+from bitcoin_rpc import BitcoinRPC
+from bitcoin_zmq import BitcoinZMQListener
+from directory_watcher import DirectoryWatcher
+from confirmation_scheduler import ConfirmationScheduler, DEFAULT_POLL_INTERVAL, DEFAULT_TIMEOUT
+from pipe_sink import PipeSink
+from seen_transactions import SeenTransactions
+from block_proofs import BlockProofCache, verify_proof, double_sha256
+from transmit_scheduler import TransmitScheduler, PRIORITY_CONTROL, PRIORITY_BULK
+from txtenna_segment import TxTennaSegment, CBOR_ENCODING
 from io import BytesIO
 ## import httplib
 import struct
 import zlib
+from collections import OrderedDict
 
 # Import support for bitcoind RPC interface
 import bitcoin
 import bitcoin.rpc
-from bitcoin.core import x, lx, b2x, b2lx, CMutableTxOut, CMutableTransaction
+from bitcoin.core import lx, b2x, b2lx, CMutableTxOut, CMutableTransaction
 from bitcoin.wallet import P2WPKHBitcoinAddress
 
-BYTE_STRING_CBOR_TAG = 24
-BITCOIN_NETWORK_CBOR_TAG = 27
-SEGMENT_NUMBER_CBOR_TAG = 28
-SEGMENT_COUNT_CBOR_TAG = 29
-SHORT_TXID_CBOR_TAG = 30
-TXID_CBOR_TAG = 31
+# number of recently broadcast payloads kept to resend missing segments from
+SENT_PAYLOADS_CACHE_SIZE = 16
+
+# seconds without new segments before the missing segments of a payload are requested
+DEFAULT_NACK_QUIET_PERIOD = 60
+
+# parity segments sent per data segment, by network, so a receiver can rebuild a payload
+# without the segments lost on the radio. 0 sends no parity segments.
+DEFAULT_PARITY_RATIOS = {'m': 0.0, 't': 0.0, 'd': 0.0}
+
+# bytes of a message file read and compressed at a time
+MESSAGE_READ_SIZE = 64 * 1024
+
+# seconds to wait for txtenna-server to answer a confirmation check
+ONLINE_CHECK_TIMEOUT = 30
+
+# payloads whose segments are held back from txtenna-server until their head segment tells what they are
+MAX_HELD_UPLOADS = 64
+
+# Header of the output data structure that the Blockstream Satellite Receiver
+# generates prior to writing user data into the API named pipe
+OUT_DATA_HEADER_FORMAT     = '64sQ'
+OUT_DATA_DELIMITER         = b'vyqzbefrsnzqahgdkrsidzigxvrppato' + \
+                             b'\xe0\xe0$\x1a\xe4["\xb5Z\x0bv\x17\xa7\xa7\x9d' + \
+                             b'\xa5\xd6\x00W}M\xa6TO\xda7\xfaeu:\xac\xdc'
 
 bitcoin.SelectParams('mainnet')
 
 class TxTenna(cmd.Cmd):
-    def __init__(self, local_gid, local_bitcoind, send_dir, receive_dir, pipe):
-
-        # store txtenna segments
-        self.segment_storage = SegmentStorage()
+    def __init__(self, local_gid, local_bitcoind, send_dir, receive_dir, pipe, segment_log=None, nack_quiet_period=DEFAULT_NACK_QUIET_PERIOD, parity_ratios=None,
+                 confirmation_poll_interval=DEFAULT_POLL_INTERVAL, confirmation_timeout=DEFAULT_TIMEOUT, zmq_addresses=None,
+                 bandwidth_khz=None, geo_region=None):
 
         # the GID of this node
         self.local_gid = local_gid
 
+        # index of the next payload broadcast by this node
+        self.messageIdx = 0
+
         ## use local bitcoind to confirm transactions if 'local' is true
         self.local_bitcoind = local_bitcoind
 
+        ## one connection to the local bitcoind, shared by all threads
+        self.bitcoin_rpc = BitcoinRPC()
+
+        ## headers and transaction ids of recent blocks, to prove confirmations to mesh clients
+        self.block_proofs = BlockProofCache(self.bitcoin_rpc.getblockproofdata)
+
+        ## received transaction segments are uploaded to txtenna-server in the background
+        self.segment_uploader = SegmentUploader()
+        ## segments heard before the head of their payload, by payload id
+        self.held_uploads = OrderedDict()
+        self.held_uploads_lock = Lock()
+        ## confirmation checks reuse their connections to txtenna-server
+        self.online_session = requests.Session()
+        if (not local_bitcoind):
+            self.segment_uploader.start()
+
+        ## every mesh send is queued and paced by the airtime the RF settings and geo region allow
+        self.transmit_scheduler = TransmitScheduler(bandwidth_khz, geo_region)
+        self.transmit_scheduler.start()
+
+        ## received messages are written to the blocksat pipe, kept open, from one thread
+        self.pipe_file = pipe
+        self.pipe_sink = None
+        if (pipe is not None):
+            self.pipe_sink = PipeSink(pipe)
+            self.pipe_sink.start()
+        self.receive_dir = receive_dir
+
+        # store txtenna segments, in an append-only log that survives restarts if one is given
+        if segment_log is not None:
+            self.segment_storage = PersistentSegmentStorage(segment_log, on_complete=self.payload_complete)
+        else:
+            self.segment_storage = ConcurrentSegmentStorage(on_complete=self.payload_complete)
+
+        ## segments of recently broadcast payloads, by payload id
+        self.sent_segments = OrderedDict()
+
+        ## forward error correction of broadcast payloads, by network
+        self.parity_ratios = dict(DEFAULT_PARITY_RATIOS)
+        if parity_ratios is not None:
+            self.parity_ratios.update(parity_ratios)
+
+        ## transactions already handled, so copies of them are not uploaded, sent or tracked again
+        self.seen_transactions = SeenTransactions()
+
+        ## poll every transaction waiting for confirmation from one thread
+        self.confirmations = ConfirmationScheduler(self.check_confirmations, self.confirmation_update,
+                                                   confirmation_poll_interval, confirmation_timeout)
+        self.confirmations.start()
+
+        ## optionally learn about mempool and block changes from the ZMQ notifications of the local bitcoind
+        self.zmq_listener = None
+        if (local_bitcoind and zmq_addresses):
+            self.zmq_listener = BitcoinZMQListener(self.confirmations, zmq_addresses)
+            self.zmq_listener.start()
+
+        ## request missing segments of payloads that stopped receiving segments, None or 0 turns it off
+        if (nack_quiet_period is not None and nack_quiet_period <= 0):
+            nack_quiet_period = None
+        self.nack_quiet_period = nack_quiet_period
+        if (nack_quiet_period is not None):
+            self.nack_thread = Thread(target=self.request_missing_segments, daemon=True)
+            self.nack_thread.start()
+
         ## broadcast message data from files in this directory, eg. created by the blocksat
         self.send_dir = send_dir
         if (send_dir is not None):
             self.do_broadcast_messages(send_dir)
 
-        self.pipe_file = pipe
-        self.receive_dir = receive_dir
+        ## payloads that completed before a restart, handled once everything they need exists
+        if segment_log is not None:
+            self.segment_storage.replay_completed()
 
     def do_send_private(self, args) :
         print("do_send_private undefined in TxTenna class.")
@@ -59,6 +158,24 @@ class TxTenna(cmd.Cmd):
     def do_send_broadcast(self, args) :
         print("do_send_broadcast undefined in TxTenna class.")
 
+    def send_broadcast_binary(self, data) :
+        print("send_broadcast_binary undefined in TxTenna class.")
+
+    def send_private_binary(self, gid, data) :
+        print("send_private_binary undefined in TxTenna class.")
+
+    def transmit(self, send, data, priority=PRIORITY_BULK):
+        """
+        Queue send(data) with the transmit scheduler instead of sending it from the calling thread
+        """
+        self.transmit_scheduler.submit(send, data, priority)
+
+    def set_rf_settings(self, bandwidth_khz=None, geo_region=None):
+        """
+        Pace mesh sends for new RF settings, to be called after the bandwidth or geo region of the device changed
+        """
+        self.transmit_scheduler.configure(bandwidth_khz, geo_region)
+
     def do_rpc_getrawtransaction(self, tx_id) :
         """
         Call local Bitcoin RPC method 'getrawtransaction'
@@ -66,173 +183,223 @@ class TxTenna(cmd.Cmd):
         Usage: rpc_sendtoaddress TX_ID
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            r = proxy.getrawtransaction(lx(tx_id), True)
+            r = self.bitcoin_rpc.call('getrawtransaction', lx(tx_id), True)
             print(str(r))
         except:
             traceback.print_exc()
 
-    def confirm_bitcoin_tx_local(self, hash, sender_gid):
+    def confirm_bitcoin_tx_local(self, hash, sender_gid, payload_id):
         """ 
-        Confirm bitcoin transaction using local bitcoind instance
+        Send a transaction reassembled from payload_id to the local bitcoind instance and wait for it to confirm
 
-        Usage: confirm_bitcoin_tx tx_id gid
+        Usage: confirm_bitcoin_tx tx_id gid payload_id
         """ 
 
-        ## send transaction to local bitcond
-        segments = self.segment_storage.get_by_transaction_id(hash)
+        ## send transaction to local bitcond, copies of it may be stored under other payload ids
+        segments = self.segment_storage.get(payload_id)
         raw_tx = self.segment_storage.get_raw_tx(segments)
 
-        ## pass hex string converted to bytes
+        ## release the reassembled segments
+        self.segment_storage.remove(payload_id)
+
+        ## pass the reassembled transaction bytes
         try :
-            proxy1 = bitcoin.rpc.Proxy()
-            raw_tx_bytes = x(raw_tx)
-            tx = CMutableTransaction.stream_deserialize(BytesIO(raw_tx_bytes))
-            r1 = proxy1.sendrawtransaction(tx)
+            tx = CMutableTransaction.stream_deserialize(BytesIO(raw_tx))
+            self.bitcoin_rpc.call('sendrawtransaction', tx)
         except :
             print("Invalid Transaction! Could not send to network.")
+            self.seen_transactions.forget(hash)
             return
 
-        ## try for 30 minutes to confirm the transaction
-        for n in range(0, 30) :
-            try :
-                proxy2 = bitcoin.rpc.Proxy()
-                r2 = proxy2.getrawtransaction(r1, True)
-
-                ## send zero-conf message back to tx sender
-                confirmations = r2.get('confirmations', 0)
-                rObj = TxTennaSegment('', '', tx_hash=hash, block=confirmations)
-                # arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-                arg = str(sender_gid) + " Transaction " + hash + " added to the mempool."
-                self.do_send_private(arg)
-
-                print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")
-                break      
-            except IndexError:
-                ## tx_id not yet in the global mempool, sleep for a minute and then try again
-                sleep(60)
-                continue      
-            
-            ## wait for atleast one confirmation
-            for m in range(0, 30):
-                sleep(60) # sleep for a minute
-                try :
-                    proxy3= bitcoin.rpc.Proxy()
-                    r3 = proxy3.getrawtransaction(r1, True)
-                    confirmations = r3.get('confirmations', 0)
-                    ## keep waiting until 1 or more confirmations
-                    if confirmations > 0:
-                        break
-                except :
-                    ## unknown RPC error, but keep trying
-                    traceback.print_exc()
-
-            if confirmations > 0 :
-                ## send confirmations message back to tx sender if confirmations > 0
-                rObj = TxTennaSegment('', '', tx_hash=hash, block=confirmations)
-                ## arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-                arg = str(sender_gid) + " Transaction " + hash + " confirmed in " + str(confirmations) + " blocks."
-                self.do_send_private(arg)
-                print("\nSent to GID: " + str(sender_gid) + ", Transaction " + hash + " confirmed in " + str(confirmations) + " blocks.")
-            else :
-                arg = str(sender_gid) + " Transaction " + hash + " not confirmed after 30 minutes."
-                self.do_send_private(arg)
-                print("\CTransaction from GID: " + str(sender_gid) + ", Transaction " + hash + " not confirmed after 30 minutes.")
+        self.confirmations.track(hash, sender_gid)
 
     def confirm_bitcoin_tx_online(self, hash, sender_gid, network):
         """ confirm bitcoin transaction using default online Samourai API instance
 
         Usage: confirm_bitcoin_tx tx_id gid network
         """
+        self.confirmations.track(hash, sender_gid, network)
 
-        if  network == 't' :
-            url = "https://api.samourai.io/test/v2/tx/" + hash ## default testnet txtenna-server
-        else :
-            url = "https://api.samourai.io/v2/tx/" + hash ## default txtenna-server
-        
-        try:
-            r = requests.get(url)
-            ## print(r.text)
-
-            while r.status_code != 200:
-                sleep(60) # sleep for a minute
-                r = requests.get(url)
-
-            ## send zero-conf message back to tx sender
-            rObj = TxTennaSegment('', '', tx_hash=hash, block=0)
-            # arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-            arg = str(sender_gid) + " Transaction " + hash + " added to the mempool."
-            self.do_send_private(arg)    
-
-            print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " added to the mempool.")            
-
-            r_text = "".join(r.text.split()) # remove whitespace
-            obj = json.loads(r_text)
-            while not 'block' in obj.keys():
-                sleep(60) # sleep for a minute
-                r = requests.get(url)
-                r_text = "".join(r.text.split())
+    def attach_duplicate(self, hash, sender_gid, network):
+        """
+        Tell sender_gid about a transaction that was already handled instead of handling it again,
+        returns False if it was not handled before
+        """
+        (seen, reply) = self.seen_transactions.lookup(hash)
+        if not seen :
+            return False
+        if reply is None or self.confirmations.get(hash) is not None :
+            ## the scheduler tells sender_gid along with the others, a confirmed transaction
+            ## only remembered by the Bloom filter is found by the first poll
+            self.confirmations.track(hash, sender_gid, network)
+        if reply is not None and sender_gid is not None :
+            self.transmit(self.do_send_private, str(sender_gid) + " " + reply, PRIORITY_CONTROL)
+        return True
+
+    def check_confirmations(self, trackers):
+        """
+        Called by the confirmation scheduler with the transactions due for a poll, returns the
+        block of the ones found by transaction hash, 0 while they are in the mempool
+        """
+        if self.local_bitcoind :
+            return self.check_confirmations_local(trackers)
+        return self.check_confirmations_online(trackers)
+
+    def check_confirmations_local(self, trackers):
+        ## the number of confirmations is reported as the block, transactions not yet
+        ## in the global mempool are left out
+        results = self.bitcoin_rpc.getrawtransactions([tracker.tx_hash for tracker in trackers])
+        for tracker in trackers :
+            if tracker.tx_hash in results :
+                tracker.block_hash = results[tracker.tx_hash].get('blockhash')
+        return dict([(tx_hash, r.get('confirmations', 0)) for tx_hash, r in results.items()])
+
+    def check_confirmations_online(self, trackers):
+        blocks = {}
+        for tracker in trackers :
+            if tracker.network == 't' :
+                url = "https://api.samourai.io/test/v2/tx/" + tracker.tx_hash ## default testnet txtenna-server
+            else :
+                url = "https://api.samourai.io/v2/tx/" + tracker.tx_hash ## default txtenna-server
+            try:
+                r = self.online_session.get(url, timeout=ONLINE_CHECK_TIMEOUT)
+                if r.status_code != 200:
+                    continue
+                r_text = "".join(r.text.split()) # remove whitespace
                 obj = json.loads(r_text)
+                blocks[tracker.tx_hash] = obj['block']['height'] if 'block' in obj.keys() else 0
+            except:
+                traceback.print_exc()
+        return blocks
+
+    def confirmation_update(self, tracker, block):
+        """
+        Called by the confirmation scheduler to tell every GID that sent a transaction how it is doing
+        """
+        hash = tracker.tx_hash
+        if block is None :
+            message = "Transaction " + hash + " not confirmed after " + str(int(self.confirmations.timeout // 60)) + " minutes."
+        elif block == 0 :
+            message = "Transaction " + hash + " added to the mempool."
+        elif self.local_bitcoind :
+            message = "Transaction " + hash + " confirmed in " + str(block) + " blocks."
+        else :
+            ## txtenna-server gives no merkle proof, those are only sent when confirming with the local bitcoind
+            message = "Transaction " + hash + " confirmed in block " + str(block) + "."
+
+        if block is None :
+            ## a later copy of it is handled again
+            self.seen_transactions.forget(hash)
+        else :
+            self.seen_transactions.set_reply(hash, message, confirmed=block > 0)
 
-            ## send block height message back to tx sender
-            blockheight = obj['block']['height']
-            rObj = TxTennaSegment('', '', tx_hash=hash, block=blockheight)
-            # arg = str(sender_gid) + ' ' + rObj.serialize_to_json()
-            # TODO: merkle proof for transaction
-            arg = str(sender_gid) + " Transaction " + hash + " confirmed in block " + str(blockheight) + "."
-            self.do_send_private(arg)
+        for sender_gid in list(tracker.gids) :
+            self.transmit(self.do_send_private, str(sender_gid) + " " + message, PRIORITY_CONTROL)
+            print("\nQueued to GID: " + str(sender_gid) + ": " + message)
 
-            print("\nSent to GID: " + str(sender_gid) + ": Transaction " + hash + " confirmed in block " + str(blockheight) + ".")
+        if block is not None and block > 0 and tracker.block_hash is not None :
+            self.send_confirmation_proof(tracker)
 
-        except:
+    def send_confirmation_proof(self, tracker):
+        """
+        Send the merkle proof of a confirmed transaction to every GID that sent it, so it can be checked offline
+        """
+        try :
+            result = self.block_proofs.proof(tracker.tx_hash, tracker.block_hash)
+        except :
             traceback.print_exc()
+            return
+        if result is None :
+            return
+
+        (height, proof) = result
+        segments = TxTennaSegment.proof_to_cbor_segments(self.local_gid, proof, tracker.tx_hash, height, str(self.messageIdx), tracker.network or 'm')
+        self.messageIdx = (self.messageIdx+1) % 9999
+        for sender_gid in list(tracker.gids) :
+            for segment in segments :
+                self.transmit(functools.partial(self.send_private_binary, sender_gid), segment.serialize_to_cbor(), PRIORITY_CONTROL)
+            print("\nQueued merkle proof of " + tracker.tx_hash + " in block " + str(height) + " to GID: " + str(sender_gid))
+
+    def receive_confirmation_proof(self, payload_id, tx_id, block):
+        """
+        Check a received merkle proof against the block header it carries
+        """
+        proof = self.segment_storage.get_raw_tx(self.segment_storage.get(payload_id))
+        self.segment_storage.remove(payload_id)
+        header = verify_proof(tx_id, proof)
+        if header is None :
+            print("\nInvalid merkle proof for transaction " + tx_id + " in block " + str(block))
+        else :
+            print("\nTransaction " + tx_id + " confirmed in block " + str(block) + ", merkle proof checked against header " + b2lx(double_sha256(header)))
+
+    def do_pending_confirmations(self, rem):
+        """
+        Show the number of transactions waiting for confirmation
+
+        Usage: pending_confirmations
+        """
+        print(str(self.confirmations.stats()))
+
+    def do_upload_stats(self, rem):
+        """
+        Show the state of the txtenna-server segment upload queue
+
+        Usage: upload_stats
+        """
+        print(str(self.segment_uploader.stats()))
 
-    def create_output_data_struct(self, data):
-        """Create the output data structure generated by the blocksat receiver
+    def do_seen_stats(self, rem):
+        """
+        Show the number of transactions remembered as handled and of duplicate copies ignored
+
+        Usage: seen_stats
+        """
+        print(str(self.seen_transactions.stats()))
+
+    def do_transmit_stats(self, rem):
+        """
+        Show the state of the mesh transmit queue and the airtime used
+
+        Usage: transmit_stats
+        """
+        print(str(self.transmit_scheduler.stats()))
+
+    def create_output_data_header(self, length):
+        """Create the header of the output data structure generated by the blocksat receiver
 
         The "Protocol Sink" block of the blocksat-rx application places the incoming
         API data into output structures. This function creates the exact same
-        structure that the blocksat-rx application would.
+        header that the blocksat-rx application would write before the data.
 
         Args:
-            data : Sequence of bytes to be placed in the output structure
+            length : Number of bytes of data that follow the header
 
         Returns:
-            Output data structure as sequence of bytes
+            Output data structure header as sequence of bytes
 
         """
 
-        # Header of the output data structure that the Blockstream Satellite Receiver
-        # generates prior to writing user data into the API named pipe
-        OUT_DATA_HEADER_FORMAT     = '64sQ'
-        OUT_DATA_DELIMITER         = 'vyqzbefrsnzqahgdkrsidzigxvrppato' + \
-                                '\xe0\xe0$\x1a\xe4["\xb5Z\x0bv\x17\xa7\xa7\x9d' + \
-                                '\xa5\xd6\x00W}M\xa6TO\xda7\xfaeu:\xac\xdc'
-
         # Struct is composed of a delimiter and the message length
-        out_data_header = struct.pack(OUT_DATA_HEADER_FORMAT,
-                                    OUT_DATA_DELIMITER,
-                                    len(data))
+        return struct.pack(OUT_DATA_HEADER_FORMAT, OUT_DATA_DELIMITER, length)
 
-        # Final output data structure
-        out_data = out_data_header + data
-
-        return out_data            
-            
-    def receive_message_from_gateway(self, filename):
+    def receive_message_from_gateway(self, filename, payload_id):
         """ 
-        Receive message data from a mesh gateway node
+        Receive message data reassembled from payload_id from a mesh gateway node
 
-        Usage: receive_message_from_gateway filename
+        Usage: receive_message_from_gateway filename payload_id
         """ 
 
-        ## send transaction to local blocksat reader pipe
-        segments = self.segment_storage.get_by_transaction_id(filename)
-        raw_data = self.segment_storage.get_raw_tx(segments).encode("utf-8")
+        ## send transaction to local blocksat reader pipe, copies of it may be stored under other payload ids
+        segments = self.segment_storage.get(payload_id)
+        raw_data = self.segment_storage.get_raw_tx(segments)
 
-        decoded_data = zlib.decompress(raw_data.decode('base64'))
+        ## release the reassembled segments
+        self.segment_storage.remove(payload_id)
 
-        deliminted_data = self.create_output_data_struct(decoded_data)
+        ## zlib data starts with 0x78, older senders base64-encode it first
+        if raw_data[:1] != b'\x78':
+            raw_data = base64.b64decode(raw_data)
+        decoded_data = zlib.decompress(raw_data)
 
         ## send the data to the blocksat pipe
         try :
@@ -241,44 +408,15 @@ class TxTenna(cmd.Cmd):
             print("Binary Data received for [" + filename + "] ( " + str(len(decoded_data)) + " bytes )\n")
         
         if not self.pipe_file is None and os.path.exists(self.pipe_file) is True :
-            # Open pipe and write raw data to it
-            pipe_f = os.open(self.pipe_file, os.O_RDWR)
-            os.write(pipe_f, deliminted_data)
+            # Queue the header and raw data for the pipe, without joining them
+            self.pipe_sink.write(self.create_output_data_header(len(decoded_data)), decoded_data)
         elif not self.receive_dir is None and os.path.exists(self.receive_dir) is True :
             # Create file
-            dump_f = os.open(os.path.join(self.receive_dir, filename), os.O_CREAT | os.O_RDWR)
-            os.write(dump_f, decoded_data)
+            with open(os.path.join(self.receive_dir, os.path.basename(filename)), 'wb') as dump_f:
+                dump_f.write(decoded_data)
         else :
             print("ERROR: Could not save data. No pipe found at [" + self.pipe_file + "] and no receive directory found at [" + self.receive_dir +"]\n")
 
-    def cbor_to_txtenna_json(self, protocol_msg):
-
-        data = protocol_msg[BYTE_STRING_CBOR_TAG]
-        if SEGMENT_NUMBER_CBOR_TAG in protocol_msg:
-            segment = protocol_msg[SEGMENT_NUMBER_CBOR_TAG]
-        else:
-            segment = 0
-        
-        if (segment == 0):
-            # only first segment contains network (optional), transaction hash and segment count
-            if BITCOIN_NETWORK_CBOR_TAG in protocol_msg:
-                network = chr(protocol_msg[BITCOIN_NETWORK_CBOR_TAG])
-            else:
-                network = 'm'
-            short_txid = protocol_msg[SHORT_TXID_CBOR_TAG]
-            txid = protocol_msg[TXID_CBOR_TAG]
-            count = protocol_msg[SEGMENT_COUNT_CBOR_TAG]
-            print("short_txid=" + short_txid.hex() + ", txid=" + txid.hex()+ ", network=" + str(network) + ", segment=" + str(segment) + ", count=" + str(count))
-            json_out = json.dumps({"i": short_txid.hex(), "h": txid.hex(), "t": data.hex(), "n": network, "c": segment, "s": count})
-        else:
-            short_txid = protocol_msg[SHORT_TXID_CBOR_TAG]
-            print("short_txid=" + short_txid.hex() + ", segment=" + str(segment))
-            json_out = json.dumps({"i": short_txid.hex(), "t": data.hex(), "c": segment})
-
-        print(" data: " + data.hex())
-
-        return json_out
-
     def handle_cbor_message(self, sender_gid, protocol_msg):
 
         # TODO: 1a) concatonate segments and send as new transaction to block explorer 
@@ -286,41 +424,192 @@ class TxTenna(cmd.Cmd):
         # TODO: 2a) monitor for transaction to be confirmed in a block
         # TODO: 2b) send blockchain confirmation back to Signal Mesh as a text message
 
-        txtenna_json = self.cbor_to_txtenna_json(protocol_msg)
-        segment = TxTennaSegment.deserialize_from_json(txtenna_json)
-        self.segment_storage.put(segment)
-        network = self.segment_storage.get_network(segment.payload_id)
+        segment = TxTennaSegment.deserialize_from_cbor(protocol_msg)
+        if (segment.sequence_num == 0):
+            print("short_txid=" + segment.payload_id + ", txid=" + segment.tx_hash + ", network=" + segment.network + ", segment=0, count=" + str(segment.segment_count))
+        else:
+            print("short_txid=" + segment.payload_id + ", segment=" + str(segment.sequence_num))
+
+        if self.segment_storage.is_duplicate(segment):
+            ## already heard this segment, eg. through another relay
+            return
+        network = segment.network if segment.tx_hash is not None else self.segment_storage.get_network(segment.payload_id)
+        ## merkle proofs of confirmations are segmented payloads with the block height in the head
+        block = segment.block if segment.tx_hash is not None else self.segment_storage.get_block(segment.payload_id)
 
         ## process incoming transaction confirmation from another server
-        if (segment.block != None):
+        if (segment.block != None and segment.segment_count is None):
             if (segment.block > 0):
                 print("\nTransaction " + segment.payload_id + " confirmed in block " + str(segment.block))
             elif (segment.block is 0):
                 print("\nTransaction " + segment.payload_id + " added to the the mem pool")
-        elif (network is 'd'):
+            return
+
+        if network != 'd' and block is None :
+            if self.seen_transactions.is_ignored(segment.payload_id) :
+                ## another segment of a copy of a handled transaction
+                return
+            if segment.tx_hash is not None and self.attach_duplicate(segment.tx_hash, sender_gid, network) :
+                print("\nTransaction " + segment.tx_hash + " already handled, ignoring payload " + segment.payload_id)
+                self.seen_transactions.ignore_payload(segment.payload_id)
+                self.segment_storage.remove(segment.payload_id)
+                self.release_held_uploads(segment.payload_id)
+                return
+
+        if not self.local_bitcoind :
+            self.upload_segment(segment, network, block)
+
+        ## payload_complete is called when this is the last missing segment
+        self.segment_storage.put(segment, sender_gid)
+
+    def upload_segment(self, segment, network, block):
+        """
+        Queue a received transaction segment for upload to txtenna-server. Until the head or a parity
+        segment tells the network of the payload, it may be message data or a merkle proof, which are
+        not uploaded, so its segments are held back.
+        """
+        with self.held_uploads_lock:
+            if network is None :
+                held = self.held_uploads.setdefault(segment.payload_id, [])
+                self.held_uploads.move_to_end(segment.payload_id)
+                if not segment.is_parity :
+                    held.append(segment)
+                while len(self.held_uploads) > MAX_HELD_UPLOADS :
+                    self.held_uploads.popitem(last=False)
+                return
+        segments = self.release_held_uploads(segment.payload_id)
+        if network == 'd' or block is not None :
+            return
+
+        ## txtenna-server has no use for parity segments
+        for upload in segments + ([] if segment.is_parity else [segment]) :
+            if not self.segment_uploader.enqueue(upload.serialize_to_json()):
+                print("Upload queue full, dropped segment " + str(upload.sequence_num) + " of " + upload.payload_id)
+
+    def release_held_uploads(self, payload_id):
+        """
+        Returns the segments held back from upload for a payload and forgets them
+        """
+        with self.held_uploads_lock:
+            return self.held_uploads.pop(payload_id, [])
+
+    def payload_complete(self, payload_id, sender_gid):
+        """
+        Called by the segment storage as soon as the last segment of a payload arrives
+        """
+        network = self.segment_storage.get_network(payload_id)
+        tx_id = self.segment_storage.get_transaction_id(payload_id)
+        block = self.segment_storage.get_block(payload_id)
+
+        if (block is not None):
+            ## merkle proof of a transaction this node sent
+            self.receive_confirmation_proof(payload_id, tx_id, block)
+        elif (network == 'd'):
             ## process message data
-            if (self.segment_storage.is_complete(segment.payload_id)):
-                filename = self.segment_storage.get_transaction_id(segment.payload_id)
-                t = Thread(target=self.receive_message_from_gateway, args=(filename,))
-                t.start()
+            t = Thread(target=self.receive_message_from_gateway, args=(tx_id, payload_id))
+            t.start()
+        elif not self.seen_transactions.add(tx_id) :
+            ## a copy that completed while the first one was handled
+            self.segment_storage.remove(payload_id)
+            self.seen_transactions.ignore_payload(payload_id)
+            self.attach_duplicate(tx_id, sender_gid, network)
+        elif (self.local_bitcoind) :
+            ## send the transaction, the confirmation scheduler waits for it to confirm. The RPC
+            ## call blocks, so it is made off the thread that put the segment
+            t = Thread(target=self.confirm_bitcoin_tx_local, args=(tx_id, sender_gid, payload_id))
+            t.start()
+        else :
+            ## the received segments were already uploaded to txtenna-server, the ones rebuilt from parity segments not yet
+            for segment in self.segment_storage.get_recovered(payload_id) or []:
+                if not self.segment_uploader.enqueue(segment.serialize_to_json()):
+                    print("Upload queue full, dropped segment " + str(segment.sequence_num) + " of " + payload_id)
+            self.segment_storage.remove(payload_id)
+            self.confirm_bitcoin_tx_online(tx_id, sender_gid, network)
+
+    def request_missing_segments(self):
+        """
+        Periodically ask the senders of stalled payloads to resend only the segments that are missing
+        """
+        while True:
+            sleep(min(self.nack_quiet_period, 10))
+            for (payload_id, missing, sender_gid) in self.segment_storage.stalled(self.nack_quiet_period):
+                if sender_gid is None or len(missing) == 0:
+                    continue
+                nack = TxTennaSegment.missing_to_json(payload_id, missing)
+                self.transmit(self.do_send_private, str(sender_gid) + " " + nack, PRIORITY_CONTROL)
+                print("\nRequested " + str(len(missing)) + " missing segments of " + payload_id + " from GID: " + str(sender_gid))
+
+    def remember_sent_segments(self, plan, segments):
+        self.sent_segments[plan.payload_id] = (plan, segments)
+        while len(self.sent_segments) > SENT_PAYLOADS_CACHE_SIZE:
+            self.sent_segments.popitem(last=False)
+
+    def handle_text_message(self, sender_gid, message):
+        """
+        Handle a private text message received from another node, returns False if it is not one
+        this node acts on. Missing segment requests of stalled payloads are answered with the segments.
+        """
+        try:
+            (payload_id, missing) = TxTennaSegment.missing_from_json(message)
+        except (ValueError, AttributeError, TypeError):
+            return False
+        print("\nGID: " + str(sender_gid) + " requested " + str(len(missing)) + " missing segments of " + payload_id)
+        self.resend_missing(payload_id, missing)
+        return True
+
+    def do_resend_missing(self, rem):
+        """
+        Resend the segments listed in a missing segments request received from a gateway
+
+        Usage: resend_missing MISSING_JSON
+
+        eg. txTenna> resend_missing {"i":"6bc1d1e2a83ffe31","r":"0,3-5"}
+        """
+        try:
+            (payload_id, missing) = TxTennaSegment.missing_from_json(rem)
+        except (ValueError, AttributeError, TypeError):
+            print("Invalid missing segments request: " + rem)
+            return
+        self.resend_missing(payload_id, missing)
+
+    def resend_missing(self, payload_id, missing):
+        if payload_id not in self.sent_segments:
+            print("Payload " + payload_id + " is no longer available to resend.")
+            return
+
+        (plan, segments) = self.sent_segments[payload_id]
+        ## streamed payloads are sent out of order, so look segments up by sequence number
+        segments = dict([(seg.sequence_num, seg) for seg in segments])
+        for sequence_num in missing:
+            if sequence_num in segments:
+                self.send_segment(plan, segments[sequence_num])
+
+    def send_segment(self, plan, segment):
+        if plan.encoding == CBOR_ENCODING:
+            self.transmit(self.send_broadcast_binary, segment.serialize_to_cbor())
         else:
-            ## process incoming tx segment
-            if not self.local_bitcoind :
-                headers = {u'content-type': u'application/json'}
-                url = "https://api.samouraiwallet.com/v2/txtenna/segments" ## default txtenna-server
-                r = requests.post(url, headers= headers, data=txtenna_json)
-                print(r.text)
-
-            if (self.segment_storage.is_complete(segment.payload_id)):
-                # sender_gid = message.sender.gid_val
-                tx_id = self.segment_storage.get_transaction_id(segment.payload_id)
-
-                ## check for confirmed transaction in a new thread
-                if (self.local_bitcoind) :
-                    t = Thread(target=self.confirm_bitcoin_tx_local, args=(tx_id, sender_gid))
-                else :
-                    t = Thread(target=self.confirm_bitcoin_tx_online, args=(tx_id, sender_gid, network))
-                t.start()
+            self.transmit(self.do_send_broadcast, segment.serialize_to_json())
+
+    def broadcast_payload(self, raw, tx_hash, network):
+        """
+        Split a payload with the encoding that needs the fewest segments and broadcast them
+        """
+        plan = TxTennaSegment.best_plan(len(raw), self.local_gid, tx_hash, str(self.messageIdx), network,
+                                        parity_ratio=self.parity_ratios.get(network, 0.0))
+        print("[ " + str(plan) + " ]")
+        self.send_segments(plan, TxTennaSegment.segments_for_plan(plan, raw))
+
+    def send_segments(self, plan, segments):
+        """
+        Queue the segments of a payload for broadcast as they are produced, and keep them to resend missing ones
+        """
+        sent = []
+        self.remember_sent_segments(plan, sent)
+        self.messageIdx = (self.messageIdx+1) % 9999
+        for seg in segments :
+            sent.append(seg)
+            self.send_segment(plan, seg)
+        return sent
 
     def do_mesh_broadcast_rawtx(self, rem):
         """ 
@@ -332,14 +621,9 @@ class TxTenna(cmd.Cmd):
         eg. txTenna> mesh_broadcast_rawtx 01000000000101bf6c3ed233e8700b42c1369993c2078780015bab7067b9751b7f49f799efbffd0000000017160014f25dbf0eab0ba7e3482287ebb41a7f6d361de6efffffffff02204e00000000000017a91439cdb4242013e108337df383b1bf063561eb582687abb93b000000000017a9148b963056eedd4a02c91747ea667fc34548cab0848702483045022100e92ce9b5c91dbf1c976d10b2c5ed70d140318f3bf2123091d9071ada27a4a543022030c289d43298ca4ca9d52a4c85f95786c5e27de5881366d9154f6fe13a717f3701210204b40eff96588033722f487a52d39a345dc91413281b31909a4018efb330ba2600000000 94406beb94761fa728a2cde836ca636ecd3c51cbc0febc87a968cb8522ce7cc1 m
         """
 
-        ## TODO: test Z85 binary encoding and add as an option
         (strHexTx, strHexTxHash, network) = rem.split(" ")
         # local_gid = self.api_thread.gid.gid_val
-        segments = TxTennaSegment.tx_to_segments(self.local_gid, strHexTx, strHexTxHash, str(self.messageIdx), network, False)
-        for seg in segments :
-            self.do_send_broadcast(seg.serialize_to_json())
-            sleep(10)
-        self.messageIdx = (self.messageIdx+1) % 9999
+        self.broadcast_payload(bytes.fromhex(strHexTx), strHexTxHash, network)
 
     def do_rpc_getbalance(self, rem) :
         """
@@ -348,8 +632,7 @@ class TxTenna(cmd.Cmd):
         Usage: rpc_getbalance
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            balance = proxy.getbalance()
+            balance = self.bitcoin_rpc.call('getbalance')
             print("getbalance: " + str(balance))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc()     
@@ -361,8 +644,7 @@ class TxTenna(cmd.Cmd):
         Usage: rpc_sendrawtransaction RAW_TX_HEX
         """
         try :
-            proxy = bitcoin.rpc.Proxy()
-            r = proxy.sendrawtransaction(hex)
+            r = self.bitcoin_rpc.call('sendrawtransaction', hex)
             print("sendrawtransaction: " + str(r))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc()
@@ -374,9 +656,8 @@ class TxTenna(cmd.Cmd):
         Usage: rpc_sendtoaddress ADDRESS SATS
         """
         try:
-            proxy = bitcoin.rpc.Proxy()
             (addr, amount) = rem.split()
-            r = proxy.sendtoaddress(addr, amount)
+            r = self.bitcoin_rpc.call('sendtoaddress', addr, amount)
             print("sendtoaddress, transaction id: " + str(r["hex"]))
         except Exception: # pylint: disable=broad-except
             traceback.print_exc() 
@@ -392,7 +673,6 @@ class TxTenna(cmd.Cmd):
         """
         try:
 
-            proxy = bitcoin.rpc.Proxy()
             (addr, sats, network) = rem.split()
 
             # Create the txout. This time we create the scriptPubKey from a Bitcoin
@@ -402,8 +682,8 @@ class TxTenna(cmd.Cmd):
 
             # Create the unsigned transaction.
             unfunded_transaction = CMutableTransaction([], [txout])
-            funded_transaction = proxy.fundrawtransaction(unfunded_transaction)
-            signed_transaction = proxy.signrawtransaction(funded_transaction["tx"])
+            funded_transaction = self.bitcoin_rpc.call('fundrawtransaction', unfunded_transaction)
+            signed_transaction = self.bitcoin_rpc.call('signrawtransaction', funded_transaction["tx"])
             txhex = b2x(signed_transaction["tx"].serialize())
             txid = b2lx(signed_transaction["tx"].GetTxid())
             print("sendtoaddress_mesh (tx, txid, network): " + txhex + ", " + txid, ", " + network)
@@ -422,7 +702,7 @@ class TxTenna(cmd.Cmd):
             ## json_outpoints = [{'txid':b2lx(outpoint.hash), 'vout':outpoint.n}
             ##              for outpoint in vin_outpoints]
             ## print(str(json_outpoints))
-            proxy.lockunspent(False, vin_outpoints)
+            self.bitcoin_rpc.call('lockunspent', False, vin_outpoints)
             
         except Exception: # pylint: disable=broad-except
             ## TODO: figure out why this is happening
@@ -443,30 +723,41 @@ class TxTenna(cmd.Cmd):
             self.watch_dir_thread.start()
 
     def watch_messages(self, send_dir):
-        
-        before = {}
-        while os.path.exists(send_dir):
-            sleep (10)
-            after = dict ([(f, None) for f in os.listdir (send_dir)])
-            new_files = [f for f in after if not f in before]
-            if new_files:
-                self.broadcast_message_files(send_dir, new_files)
-            before = after
+        ## broadcast every file once it is completely written, files already broadcast are
+        ## kept in an index in send_dir so they are not broadcast again after a restart
+        watcher = DirectoryWatcher(send_dir, lambda directory, filename: self.broadcast_message_files(directory, [filename]))
+        watcher.run()
 
     def broadcast_message_files(self, directory, filenames):
         for filename in filenames:
-            print("Broadcasting ",directory+"/"+filename)
-            f = open(directory+"/"+filename,'r')
-            message_data = f.read()
-            f.close
-            
-            ## binary to ascii encoding and strip out newlines
-            encoded = zlib.compress(message_data, 9).encode('base64').replace('\n','')
-            print("[\n" + encoded.decode() + "\n]")
-
+            path = os.path.join(directory, filename)
+            print("Broadcasting ", path)
+            size = os.path.getsize(path)
+
+            ## the file is read, compressed and sent in binary CBOR segments a piece at a time, so the first
+            ## segments go out while the rest is still being compressed. The head segment carrying the
+            ## segment count is sent last, segments are sized for the longest the compressed data can get.
+            ## Parity segments are only added when that many segments are covered by the erasure code.
             # local_gid = self.api_thread.gid.gid_val
-            segments = TxTennaSegment.tx_to_segments(self.local_gid, encoded, filename, str(self.messageIdx), "d", False)
-            for seg in segments :
-                self.do_send_broadcast(seg.serialize_to_json())
-                sleep(10)
-            self.messageIdx = (self.messageIdx+1) % 9999
\ No newline at end of file
+            plan = TxTennaSegment.plan(zlib_compress_bound(size), self.local_gid, filename, str(self.messageIdx), "d",
+                                       CBOR_ENCODING, parity_ratio=self.parity_ratios.get("d", 0.0))
+            with open(path, 'rb') as f:
+                segments = self.send_segments(plan, TxTennaSegment.stream_segments_for_plan(plan, self.compress_file(f)))
+            compressed = sum([len(seg.data) for seg in segments if not seg.is_parity])
+            print("[ " + str(size) + " bytes compressed to " + str(compressed) + " bytes in " + str(len(segments)) + " segments ]")
+
+    def compress_file(self, f):
+        compressor = zlib.compressobj(9)
+        while True:
+            data = f.read(MESSAGE_READ_SIZE)
+            if not data:
+                break
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+def zlib_compress_bound(length):
+    """ Most bytes zlib can compress length bytes to, see deflateBound
+    """
+    return length + (length >> 12) + (length >> 14) + (length >> 25) + 13 + 6
@@ -5,24 +5,133 @@ https://github.com/kansas-city-bitcoin-developers/PyMuleTools
 '''
 
 import json
+import cbor
 from zmq.utils import z85
 import hashlib
+import math
 import string
+import erasure_code
+
+# highest number of segments a payload may be split into
+MAX_SEGMENT_COUNT = 65536
+
+# keys of the binary CBOR segment layout
+BYTE_STRING_CBOR_TAG = 24
+BITCOIN_NETWORK_CBOR_TAG = 27
+SEGMENT_NUMBER_CBOR_TAG = 28
+SEGMENT_COUNT_CBOR_TAG = 29
+SHORT_TXID_CBOR_TAG = 30
+TXID_CBOR_TAG = 31
+PARITY_COUNT_CBOR_TAG = 32
+PAYLOAD_LENGTH_CBOR_TAG = 33
+BLOCK_HEIGHT_CBOR_TAG = 37  ## head of a payload holding the merkle proof of a confirmation, see block_proofs
+
+# largest number of bytes the block height key and value add to a CBOR head segment
+BLOCK_HEIGHT_CBOR_SIZE = 7
+
+# bytes available for one binary mesh message
+MESH_PAYLOAD_SIZE = 150
+
+# text encodings of the segment data in the JSON form
+HEX_ENCODING = 'hex'    ## raw transaction bytes as hex
+Z85_ENCODING = 'z85'    ## Z85-encoded bytes, data length must be a multiple of 4
+TEXT_ENCODING = 'text'  ## data is already ascii text, eg. base64 message data
+
+# segments sent as binary CBOR maps rather than JSON, see serialize_to_cbor
+CBOR_ENCODING = 'cbor'
+
+# rough figures for the mesh radio, only used to predict the airtime of a segment plan
+MESH_BITRATE = 1200              ## bits per second over the air
+SEGMENT_OVERHEAD_SECONDS = 0.5   ## preamble, mesh headers and turnaround of each message
+
+class SegmentPlan:
+    """ How a payload of length bytes is split: the encoding segments are sent in, the data
+    bytes carried by the head and tail segments, the resulting segment count, the number
+    of parity segments sent after them and an upper bound of the bytes sent on air.
+    payload_id and tx_hash are the values as they appear in the segments, eg. Z85-encoded.
+    """
+
+    def __init__(self, encoding, length, payload_id, tx_hash, network, head_len, tail_len, segment_count, air_bytes, parity_count=0):
+        self.encoding = encoding
+        self.length = length
+        self.payload_id = payload_id
+        self.tx_hash = tx_hash
+        self.network = network
+        self.head_len = head_len
+        self.tail_len = tail_len
+        self.segment_count = segment_count
+        self.parity_count = parity_count
+        self.air_bytes = air_bytes
+
+    def airtime(self, bitrate=MESH_BITRATE):
+        """ Predicted seconds on air to send every segment once
+        """
+        return (self.segment_count + self.parity_count) * SEGMENT_OVERHEAD_SECONDS + self.air_bytes * 8.0 / bitrate
+
+    def __str__(self):
+        return "{} bytes in {} {} segments + {} parity, {} bytes on air, ~{:.1f} s airtime".format(
+            self.length, self.segment_count, self.encoding, self.parity_count, self.air_bytes, self.airtime())
 
 class TxTennaSegment:
+    """ A single segment of a payload.
+
+    The segment data is held as bytes (or a memoryview over them), its hex, Z85
+    or text form is only built when the payload property is read, eg. by
+    serialize_to_json. A payload given as a string is decoded with encoding.
+
+    A payload sent with forward error correction is followed by parity_count parity
+    segments, numbered from segment_count. The data segments are the same as without
+    them, the parity segments carry the segment count, parity count and payload length,
+    so the head and any segment_count - 1 of the others are enough to rebuild it.
+    """
 
-    def __init__(self, payload_id, payload, tx_hash=None, sequence_num=0, testnet=False, segment_count=None, block=None, message=False):
+    __slots__ = ('segment_count', 'tx_hash', 'payload_id', 'testnet', 'sequence_num', 'data', 'encoding', 'block', 'message', 'parity_count', 'payload_length')
+
+    def __init__(self, payload_id, payload, tx_hash=None, sequence_num=0, testnet=False, segment_count=None, block=None, message=False, encoding=HEX_ENCODING, parity_count=0, payload_length=None):
         self.segment_count = segment_count
+        self.parity_count = parity_count
+        self.payload_length = payload_length
         self.tx_hash = tx_hash
         self.payload_id = payload_id
         self.testnet = testnet
         self.sequence_num = sequence_num
-        self.payload = payload
+        self.encoding = encoding
+        self.data = self.decode_payload(payload, encoding) if isinstance(payload, str) else payload
         self.block = block
         self.message = message
 
+    @staticmethod
+    def decode_payload(payload, encoding):
+        if encoding == HEX_ENCODING:
+            return bytes.fromhex(payload)
+        if encoding == Z85_ENCODING:
+            return z85.decode(payload.encode('ascii'))
+        return payload.encode('ascii')
+
+    @property
+    def payload(self):
+        if self.data is None:
+            return None
+        if self.encoding == HEX_ENCODING:
+            return self.data.hex()
+        if self.encoding == Z85_ENCODING:
+            return z85.encode(bytes(self.data)).decode('ascii')
+        return bytes(self.data).decode('ascii')
+
+    @property
+    def network(self):
+        if self.testnet:
+            return 't' ## testnet
+        if self.message:
+            return 'd' ## data network
+        return 'm'
+
+    @property
+    def is_parity(self):
+        return self.parity_count > 0 and self.sequence_num > 0 and self.segment_count is not None and self.sequence_num >= self.segment_count
+
     def __str__(self):
-        return "Tx {self.tx_hash} Part {self.sequence_num}"
+        return "Tx {} Part {}".format(self.tx_hash, self.sequence_num)
 
     def __repr__(self):
         return self.serialize_to_json()
@@ -36,10 +145,19 @@ class TxTennaSegment:
         if self.sequence_num > 0:
             data["c"] = self.sequence_num
 
-        if self.sequence_num == 0:
+        if self.sequence_num == 0 or self.is_parity:
             data["s"] = self.segment_count
+
+        if self.sequence_num == 0:
             data["h"] = self.tx_hash
 
+        if self.is_parity:
+            data["p"] = self.parity_count
+            data["l"] = self.payload_length
+
+        if self.block and self.segment_count is not None and self.sequence_num == 0:
+            data["b"] = self.block
+
         if self.testnet:
             data["n"] = "t"
 
@@ -47,7 +165,7 @@ class TxTennaSegment:
             data["n"] = "d"
 
         # transaction confirmations contain only two elements
-        if self.block:
+        if self.block and self.segment_count is None:
             data = {
                 "h": self.tx_hash,
                 "b": self.block
@@ -55,15 +173,76 @@ class TxTennaSegment:
 
         return json.dumps(data,separators=(',',':'))
 
+    def to_cbor_map(self):
+        protocol_msg = {
+            BYTE_STRING_CBOR_TAG: bytes(self.data),
+            SHORT_TXID_CBOR_TAG: bytes.fromhex(self.payload_id)
+        }
+
+        if self.sequence_num > 0:
+            protocol_msg[SEGMENT_NUMBER_CBOR_TAG] = self.sequence_num
+
+        if self.sequence_num == 0:
+            ## message data is identified by its file name rather than a transaction hash
+            protocol_msg[TXID_CBOR_TAG] = self.tx_hash.encode("utf-8") if self.message else bytes.fromhex(self.tx_hash)
+            if self.block is not None:
+                protocol_msg[BLOCK_HEIGHT_CBOR_TAG] = self.block
+
+        if self.sequence_num == 0 or self.is_parity:
+            protocol_msg[SEGMENT_COUNT_CBOR_TAG] = self.segment_count
+            if self.network != 'm':
+                protocol_msg[BITCOIN_NETWORK_CBOR_TAG] = ord(self.network)
+
+        if self.is_parity:
+            protocol_msg[PARITY_COUNT_CBOR_TAG] = self.parity_count
+            protocol_msg[PAYLOAD_LENGTH_CBOR_TAG] = self.payload_length
+
+        return protocol_msg
+
+    def serialize_to_cbor(self):
+        """ Binary form of the segment, the payload of a goTenna BinaryPayload
+        """
+        return cbor.dumps(self.to_cbor_map())
+
+    def cbor_data_capacity(self, payload_size):
+        """ Number of data bytes a segment with these headers can carry in payload_size bytes
+        """
+        protocol_msg = self.to_cbor_map()
+        capacity = payload_size - len(cbor.dumps(protocol_msg))
+        ## the byte string length prefix grows with the data
+        while capacity > 0:
+            protocol_msg[BYTE_STRING_CBOR_TAG] = bytes(capacity)
+            if len(cbor.dumps(protocol_msg)) <= payload_size:
+                break
+            capacity -= 1
+        return capacity
+
+    def json_data_capacity(self, payload_size):
+        """ Number of data bytes a segment with these headers can carry in payload_size characters of JSON
+        """
+        chars = payload_size - len(self.serialize_to_json())
+        if self.encoding == HEX_ENCODING:
+            return chars // 2
+        if self.encoding == Z85_ENCODING:
+            ## 4 bytes per 5 characters, every segment must hold whole 4 byte groups
+            return chars // 5 * 4
+        return chars
+
     @classmethod
-    def deserialize_from_json(cls, json_string):
-        data = json.loads(json_string)
+    def deserialize_from_json(cls, json_string, encoding=HEX_ENCODING):
+        return cls.deserialize_from_dict(json.loads(json_string), encoding)
 
+    @classmethod
+    def deserialize_from_dict(cls, data, encoding=HEX_ENCODING):
+        """ Build a segment from a decoded segment JSON. The JSON does not tell how the
+        data is encoded, so the encoding the sender used must be given, eg. TEXT_ENCODING
+        for message data sent as JSON.
+        """
         # Validate
         if not cls.segment_json_is_valid(data):
             raise AttributeError(
                 'Segment JSON is valid but not properly constructed. Refer to MuleTools documentation for details.\r\n\
-                    {json_string}')
+                    {data}')
 
         # present for normal segments, but not for block confirmations
         payload_id = data["i"] if "i" in data else ''
@@ -76,6 +255,10 @@ class TxTennaSegment:
         segment_count = data["s"] if "s" in data else None
         tx_hash = data["h"] if "h" in data else None
 
+        # Forward error correction
+        parity_count = data["p"] if "p" in data else 0
+        payload_length = data["l"] if "l" in data else None
+
         # Optional network flag
         testnet = True if "n" in data and data["n"] == "t" else False
         message = True if "n" in data and data["n"] == "d" else False
@@ -83,7 +266,46 @@ class TxTennaSegment:
         # Block confirmation
         block = data["b"] if "b" in data else None
 
-        return cls( payload_id, payload, tx_hash=tx_hash, sequence_num=sequence_num, testnet=testnet, segment_count=segment_count, block=block,message=message)
+        return cls( payload_id, payload, tx_hash=tx_hash, sequence_num=sequence_num, testnet=testnet, segment_count=segment_count, block=block,message=message, encoding=encoding,
+                    parity_count=parity_count, payload_length=payload_length)
+
+    @classmethod
+    def deserialize_from_cbor(cls, protocol_msg):
+        """ Build a segment straight from a decoded CBOR segment map. Only the first (and
+        parity) segments of a payload carry the network (optional), transaction hash and segment count.
+        """
+        try:
+            data = protocol_msg[BYTE_STRING_CBOR_TAG]
+            payload_id = protocol_msg[SHORT_TXID_CBOR_TAG].hex()
+            sequence_num = protocol_msg.get(SEGMENT_NUMBER_CBOR_TAG, 0)
+            if not isinstance(data, bytes) or not isinstance(sequence_num, int):
+                raise TypeError()
+
+            if sequence_num != 0 and PARITY_COUNT_CBOR_TAG not in protocol_msg:
+                return cls(payload_id, data, sequence_num=sequence_num)
+
+            ## parity segments do not carry the transaction hash
+            txid = protocol_msg[TXID_CBOR_TAG] if sequence_num == 0 else None
+            segment_count = protocol_msg[SEGMENT_COUNT_CBOR_TAG]
+            network = chr(protocol_msg.get(BITCOIN_NETWORK_CBOR_TAG, ord('m')))
+            tx_hash = txid.hex() if txid is not None else None
+            if network == 'd' and txid is not None:
+                ## message data is identified by its file name
+                try:
+                    tx_hash = txid.decode("utf-8")
+                except UnicodeDecodeError:
+                    pass
+            parity_count = protocol_msg.get(PARITY_COUNT_CBOR_TAG, 0)
+            payload_length = protocol_msg.get(PAYLOAD_LENGTH_CBOR_TAG)
+            block = protocol_msg.get(BLOCK_HEIGHT_CBOR_TAG)
+            if not isinstance(segment_count, int) or not isinstance(parity_count, int) or \
+                    (parity_count > 0 and not isinstance(payload_length, int)) or (block is not None and not isinstance(block, int)):
+                raise TypeError()
+        except (KeyError, TypeError, AttributeError, ValueError):
+            raise AttributeError('Segment CBOR is not properly constructed: ' + str(protocol_msg))
+
+        return cls(payload_id, data, tx_hash=tx_hash, sequence_num=sequence_num, segment_count=segment_count, testnet=network == 't', message=network == 'd',
+                   block=block, parity_count=parity_count, payload_length=payload_length)
 
     @classmethod
     def segment_json_is_valid(cls, data):
@@ -92,13 +314,44 @@ class TxTennaSegment:
                         ("s" in data and "h" in data and ("c" not in data or ("c" in data and data["c"] == 0)))
                         or
                         ("c" in data and data["c"] > 0 and "s" not in data and "h" not in data)
+                        or
+                        ("c" in data and "p" in data and "l" in data and "s" in data and data["c"] >= data["s"])
                 ) or
                 ("b" in data and data["b"] >= 0 and "h" in data))
 
     @classmethod
-    def tx_to_segments(self, gid, strHexTx, strHexTxHash, messageIdx=0, network='m', isZ85=False):
+    def missing_to_json(cls, payload_id, missing):
         ##
-        ## if Z85 encoding, use 24 extra characters for tx in segment0. Hash encoded on 40 characters instead of 64
+        ## Request the segments of a payload that were not received, eg. {"i":"6bc1d1e2a83ffe31","r":"0,3-5"}
+        ##
+        ##    * **i** - `string` - TxTenna unid identifying the transaction (8 bytes).
+        ##    * **r** - `string` - Comma separated sequence numbers, consecutive runs written as FIRST-LAST.
+        runs = []
+        for sequence_num in sorted(missing):
+            if runs and runs[-1][1] == sequence_num - 1:
+                runs[-1][1] = sequence_num
+            else:
+                runs.append([sequence_num, sequence_num])
+        ranges = ",".join([str(first) if first == last else str(first) + "-" + str(last) for first, last in runs])
+        return json.dumps({"i": payload_id, "r": ranges}, separators=(',',':'))
+
+    @classmethod
+    def missing_from_json(cls, json_string):
+        """ Returns (payload_id, missing sequence numbers) from a missing segments request
+        """
+        data = json.loads(json_string)
+        if not isinstance(data, dict) or "i" not in data or "r" not in data:
+            raise AttributeError('Missing segments JSON is not properly constructed: ' + json_string)
+        missing = []
+        for run in data["r"].split(","):
+            first, _, last = run.partition("-")
+            missing.extend(range(int(first), min(int(last or first) + 1, MAX_SEGMENT_COUNT)))
+        return (data["i"], missing)
+
+    @classmethod
+    def tx_to_segments(self, gid, strHexTx, strHexTxHash, messageIdx=0, network='m', isZ85=False, payload_size=MESH_PAYLOAD_SIZE, parity_ratio=0.0):
+        ##
+        ## if Z85 encoding, the hash is encoded on 40 characters instead of 64
         ##
         ## This method translated to python from txTenna app PayloadFactory.java : toJSON method
         ##
@@ -110,77 +363,240 @@ class TxTennaSegment:
         ##    * **c** - `integer` - Sequence number for this segment. May be omitted in first segment for a given transaction (assumed to be 0).
         ##    * **t** - `string` - Hex transaction data for this segment. May be Z85-encoded.
         ##    * **b** - `integer` - Block height of corresponding transaction hash. Will be 0 for mempool transactions.
+        ##    * **p** - `integer` (optional) - Number of parity segments sent after the data segments. Only used in the parity segments.
+        ##    * **l** - `integer` (optional) - Length of the payload in bytes, sent along with **p**.
+        ##
+        ## Parity segments are numbered from **s** and also carry **s** and **n**, but not **h**.
+        ##
+        ## Returns a generator that yields the segments one at a time, each filling up to payload_size characters.
 
-        segment0Len = 100  ## 110?
-        segment1Len = 180  ## 190?
-
-        if isZ85 : 
-            segment0Len += 24
+        if isinstance(strHexTx, str) :
+            ## message data is already text (base64), transactions are hex
+            raw = strHexTx.encode('ascii') if network == 'd' else bytes.fromhex(strHexTx)
+        else :
+            raw = strHexTx
 
-        strRaw = strHexTx
         if isZ85 :
-            strRaw = z85.encode(strHexTx)
-
-        length = len(strRaw)
-
-        seg_count = 0
-        if length <= segment0Len :
-            seg_count = 1
+            encoding = Z85_ENCODING
+        elif network == 'd' :
+            encoding = TEXT_ENCODING
         else :
-            length -= segment0Len
-            seg_count = 1
-            seg_count += (length / segment1Len)
-            if length % segment1Len > 0 :
-                seg_count += 1
+            encoding = HEX_ENCODING
 
-        tx_id = messageIdx
+        plan = self.plan(len(raw), gid, strHexTxHash, messageIdx, network, encoding, payload_size, parity_ratio)
+        return self.segments_for_plan(plan, raw)
 
-        # a unique identifier for set of segments from a particular node
+    @classmethod
+    def payload_id_for(cls, gid, messageIdx):
+        """ A unique identifier for set of segments from a particular node, the hex
+        of the first 8 bytes of the md5 digest of "GID|INDEX"
+        """
         _id = str(gid) + "|" + str(messageIdx)
+        return hashlib.md5(_id.encode("utf-8")).digest()[:8].hex()
 
-        try :
-            buf = _id.decode("UTF-8")
-            md5_hash = hashlib.md5().update(buf).digest()
-            idBytes = md5_hash[:8] ## first 8 bytes of md5 digest
-            if isZ85 :
-                tx_id = z85.encode(idBytes.encode("hex"))
-            else :
-                tx_id = idBytes.encode("hex")
-        except Exception: # pylint: disable=broad-except
-            return None
+    @classmethod
+    def tx_to_cbor_segments(cls, gid, raw, strHexTxHash, messageIdx=0, network='m', payload_size=MESH_PAYLOAD_SIZE, parity_ratio=0.0):
+        """ Split raw transaction (or message data) bytes into segments that are sent as
+        binary CBOR maps, see serialize_to_cbor, each filling up to payload_size bytes.
+        parity_ratio parity segments per data segment are added, see plan.
 
-        ret = []
-        for seg_num in range(0, seg_count) :
-
-            if seg_num == 0 :
-                if isZ85 :
-                    tx_hash = z85.encode(strHexTxHash.decode("hex"))
-                else :
-                    tx_hash = strHexTxHash
-
-                seg_len = len(strRaw)
-
-                tx_seg = strRaw
-                if seg_len > segment0Len :
-                    seg_len = segment0Len
-                    tx_seg = strRaw[:seg_len]
-                    strRaw = strRaw[seg_len:]
-                
-                testnet = network is 't' ## testnet
-                message = network is 'd' ## data network
-                rObj = TxTennaSegment(tx_id, tx_seg, tx_hash=tx_hash, segment_count=seg_count, testnet=testnet, message=message)
-                ret.append(rObj)
-
-            else :
-                seg_len = len(strRaw)
-                tx_seg = strRaw
-                if seg_len > segment1Len :
-                    seg_len = segment1Len
-                    tx_seg = strRaw[:seg_len]
-                    strRaw = strRaw[seg_len:]
-
-                rObj = TxTennaSegment(tx_id, tx_seg, sequence_num=seg_num)
-                ret.append(rObj)
-
-        return ret
+        Returns a generator that yields the segments one at a time.
+        """
+        plan = cls.plan(len(raw), gid, strHexTxHash, messageIdx, network, CBOR_ENCODING, payload_size, parity_ratio)
+        return cls.segments_for_plan(plan, raw)
 
+    @classmethod
+    def proof_to_cbor_segments(cls, gid, proof, strHexTxHash, block, messageIdx=0, network='m', payload_size=MESH_PAYLOAD_SIZE):
+        """ Split the merkle proof of a transaction confirmed in block (its height) into CBOR
+        segments, the head segment carries the height. Returns a list of the segments.
+        """
+        ## room for the block height is left in every segment, only the head uses it
+        plan = cls.plan(len(proof), gid, strHexTxHash, messageIdx, network, CBOR_ENCODING, payload_size - BLOCK_HEIGHT_CBOR_SIZE)
+        segments = list(cls.segments_for_plan(plan, proof))
+        segments[0].block = block
+        return segments
+
+    @classmethod
+    def plan(cls, length, gid, strHexTxHash, messageIdx=0, network='m', encoding=CBOR_ENCODING, payload_size=MESH_PAYLOAD_SIZE, parity_ratio=0.0):
+        """ Work out how length bytes are split into segments of at most payload_size bytes
+        (characters for the JSON encodings) sent in encoding. With a parity_ratio, that many
+        parity segments per data segment (rounded up) are added for forward error correction.
+        Raises ValueError if the payload can not be sent that way.
+        """
+        payload_id = cls.payload_id_for(gid, messageIdx)
+        tx_hash = strHexTxHash
+        if encoding == Z85_ENCODING :
+            if length % 4 != 0 :
+                raise ValueError("Z85 encoded payloads must be a multiple of 4 bytes long")
+            payload_id = z85.encode(payload_id.encode("ascii")).decode("ascii")
+            if network != 'd' :
+                tx_hash = z85.encode(bytes.fromhex(strHexTxHash)).decode("ascii")
+        if encoding == TEXT_ENCODING and parity_ratio > 0 :
+            raise ValueError("Parity segments can not be sent as text")
+
+        ## CBOR segments carry the data as is, the JSON form in the text encoding
+        text_encoding = HEX_ENCODING if encoding == CBOR_ENCODING else encoding
+
+        def capacity(segment):
+            if encoding == CBOR_ENCODING :
+                return segment.cbor_data_capacity(payload_size)
+            return segment.json_data_capacity(payload_size)
+
+        ## the size of the headers depends on the segment count and sequence numbers,
+        ## so settle the data capacity of the head and tail segments on the count they result in
+        seg_count = 1
+        while True:
+            parity_count = cls.parity_count_for(seg_count, parity_ratio)
+            head = cls(payload_id, b'', tx_hash=tx_hash, segment_count=seg_count, testnet=network == 't', message=network == 'd', encoding=text_encoding)
+            tail = cls(payload_id, b'', sequence_num=max(seg_count - 1, 1), encoding=text_encoding)
+            head_len = capacity(head)
+            tail_len = capacity(tail)
+            if parity_count > 0 :
+                ## a parity segment holds a shard as long as the longest data segment next to the
+                ## payload metadata, the tails are only shortened as far as that needs
+                parity = cls(payload_id, b'', sequence_num=seg_count + parity_count - 1, segment_count=seg_count,
+                             testnet=network == 't', message=network == 'd', encoding=text_encoding, parity_count=parity_count, payload_length=length)
+                tail_len = min(tail_len, capacity(parity))
+                head_len = min(head_len, tail_len)
+            if head_len <= 0 or tail_len <= 0:
+                raise ValueError("Segment header does not fit in a " + str(payload_size) + " byte payload")
+            count = cls.segment_count_for(length, head_len, tail_len)
+            if count <= seg_count:
+                break
+            seg_count = count
+
+        ## every segment but the last is filled up, only the unused room in the last one is left off the air
+        unused = head_len + (count - 1) * tail_len - length
+        if encoding == HEX_ENCODING :
+            unused = unused * 2
+        elif encoding == Z85_ENCODING :
+            unused = unused * 5 // 4
+        air_bytes = (count + parity_count) * payload_size - unused
+
+        return SegmentPlan(encoding, length, payload_id, tx_hash, network, head_len, tail_len, count, air_bytes, parity_count)
+
+    @classmethod
+    def parity_count_for(cls, segment_count, parity_ratio):
+        """ Number of parity segments to send with segment_count data segments, none when
+        the erasure code can not cover that many segments
+        """
+        if parity_ratio <= 0 :
+            return 0
+        parity_count = int(math.ceil(segment_count * parity_ratio))
+        return max(0, min(parity_count, erasure_code.MAX_SHARD_COUNT - segment_count))
+
+    @classmethod
+    def best_plan(cls, length, gid, strHexTxHash, messageIdx=0, network='m', encodings=(CBOR_ENCODING, HEX_ENCODING, Z85_ENCODING), payload_size=MESH_PAYLOAD_SIZE, parity_ratio=0.0):
+        """ Plan the payload in each of encodings that can carry it and return the plan with the
+        fewest segments, the first one of encodings on a tie.
+        """
+        plans = []
+        for encoding in encodings:
+            try:
+                plans.append(cls.plan(length, gid, strHexTxHash, messageIdx, network, encoding, payload_size, parity_ratio))
+            except ValueError:
+                continue
+        if len(plans) == 0:
+            raise ValueError("None of " + ", ".join(encodings) + " can carry the payload in " + str(payload_size) + " bytes")
+        return min(plans, key=lambda plan: plan.segment_count + plan.parity_count)
+
+    @classmethod
+    def segments_for_plan(cls, plan, raw):
+        """ Returns a generator that yields the segments of raw as laid out by plan
+        """
+        text_encoding = HEX_ENCODING if plan.encoding == CBOR_ENCODING else plan.encoding
+        return cls.payload_to_segments(plan.payload_id, raw, plan.tx_hash, plan.network, plan.head_len, plan.tail_len, text_encoding, plan.parity_count)
+
+    @classmethod
+    def stream_segments_for_plan(cls, plan, chunks):
+        """ Like segments_for_plan, for a payload read as an iterable of byte chunks, eg. from a
+        zlib compressobj, that add up to at most plan.length bytes. Each tail segment is yielded
+        as soon as its data arrived, the head segment, which carries the segment count, and
+        any parity segments only once chunks is exhausted.
+        """
+        text_encoding = HEX_ENCODING if plan.encoding == CBOR_ENCODING else plan.encoding
+        head_len = plan.head_len
+        tail_len = plan.tail_len
+        head = None
+        shards = []
+        pending = b''
+        length = 0
+        seg_num = 1
+
+        for chunk in chunks:
+            length += len(chunk)
+            if length > plan.length:
+                raise ValueError("Payload is longer than the " + str(plan.length) + " bytes planned for")
+            pending += chunk
+            offset = 0
+            if head is None:
+                if len(pending) < head_len:
+                    continue
+                head = pending[:head_len]
+                offset = head_len
+            while len(pending) - offset >= tail_len:
+                data = pending[offset:offset + tail_len]
+                offset += tail_len
+                if plan.parity_count > 0:
+                    shards.append(data)
+                yield cls(plan.payload_id, data, sequence_num=seg_num, encoding=text_encoding)
+                seg_num += 1
+            pending = pending[offset:]
+
+        if head is None:
+            head = pending
+        elif len(pending) > 0:
+            if plan.parity_count > 0:
+                shards.append(pending)
+            yield cls(plan.payload_id, pending, sequence_num=seg_num, encoding=text_encoding)
+            seg_num += 1
+
+        ## as many parity segments per data segment as planned, the headers are no bigger than planned for
+        seg_count = seg_num
+        parity_count = min(plan.parity_count, -(-seg_count * plan.parity_count // plan.segment_count))
+        yield cls(plan.payload_id, head, tx_hash=plan.tx_hash, segment_count=seg_count,
+                  testnet=plan.network == 't', message=plan.network == 'd', encoding=text_encoding)
+
+        if parity_count > 0 :
+            ## the head and last segment are zero padded to the shard size for encoding only
+            shards = [shard.ljust(tail_len, b'\0') for shard in [head] + shards]
+            for parity_num, parity in enumerate(erasure_code.encode(shards, parity_count)) :
+                yield cls(plan.payload_id, parity, sequence_num=seg_count + parity_num, segment_count=seg_count,
+                          testnet=plan.network == 't', message=plan.network == 'd', encoding=text_encoding,
+                          parity_count=parity_count, payload_length=length)
+
+    @classmethod
+    def segment_count_for(cls, length, head_len, tail_len):
+        if length <= head_len :
+            return 1
+        return 1 + (length - head_len + tail_len - 1) // tail_len
+
+    @classmethod
+    def payload_to_segments(cls, payload_id, raw, tx_hash, network, head_len, tail_len, encoding=HEX_ENCODING, parity_count=0):
+        """ Lazily split raw payload bytes into a head segment holding up to head_len bytes,
+        followed by segments of up to tail_len bytes. The segments hold memoryview slices
+        of raw, so the payload is never copied.
+
+        With parity_count, head_len must not be longer than tail_len and parity_count
+        parity segments follow, they are only computed once all data segments were yielded.
+        """
+        view = memoryview(raw)
+        seg_count = cls.segment_count_for(len(view), head_len, tail_len)
+
+        yield cls(payload_id, view[:head_len], tx_hash=tx_hash, segment_count=seg_count,
+                  testnet=network == 't', message=network == 'd', encoding=encoding)
+
+        offset = head_len
+        for seg_num in range(1, seg_count) :
+            yield cls(payload_id, view[offset:offset + tail_len], sequence_num=seg_num, encoding=encoding)
+            offset += tail_len
+
+        if parity_count > 0 :
+            ## the head and last segment are zero padded to the shard size for encoding only
+            offsets = [0] + list(range(head_len, len(view), tail_len))
+            ends = offsets[1:] + [len(view)]
+            shards = [bytes(view[start:end]).ljust(tail_len, b'\0') for start, end in zip(offsets, ends)]
+            for parity_num, parity in enumerate(erasure_code.encode(shards, parity_count)) :
+                yield cls(payload_id, parity, sequence_num=seg_count + parity_num, segment_count=seg_count,
+                          testnet=network == 't', message=network == 'd', encoding=encoding,
+                          parity_count=parity_count, payload_length=len(view))